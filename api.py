@@ -0,0 +1,194 @@
+# 提携旅行サイト向けの予約 API（ASGI）
+#
+# 画面（app.py）と同じ予約ストア・受付上限の索引・料金表（backend.py）を共有する。
+# - 画面と同じプロセスで起動: FARM_API_PORT=8000 streamlit run app.py
+# - API だけを起動: uvicorn --factory api:create_standalone_app --port 8000
+#
+# 照会（農園検索・空き状況）は作成済みの受付上限の索引・料金表の参照だけをイベントループ上で処理する。
+# 索引が使えない場合（起動直後・日付の変更時）の作り直しはスレッドで待ち、定期的な作り直しは
+# backend.py がバックグラウンドで行う。予約ストアを更新する処理（予約・キャンセル）は上限付きのワーカープールで実行する。
+import threading
+from contextlib import asynccontextmanager
+from functools import partial
+
+import pandas as pd
+import uvicorn
+from anyio import CapacityLimiter, to_thread
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from schema import PARTY_COLUMNS, format_time_slot
+
+STORE_POOL_SIZE = 8                # 予約ストアを更新するワーカー数
+MAX_PARTY_SIZE = 30                # 1件の予約で受け付ける最大人数
+FARM_FIELDS = [
+    "id", "name", "location", "main_crop", "harvest_season_start", "harvest_season_end", "rating"
+]
+
+
+# エラー応答
+def _error(status_code, message):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+
+# 日付の解釈（未指定・不正な形式の場合は None）
+def _parse_date(value):
+    try:
+        date = pd.Timestamp(value)
+    except (TypeError, ValueError):
+        return None
+    return None if pd.isna(date) else date.normalize()
+
+
+# 予約リクエストの検証（エラーメッセージと変換後の値）
+def _validate_reservation(body, farm_ids, customer_ids, time_slots):
+    try:
+        farm_id = int(body["farm_id"])
+        customer_id = int(body["customer_id"])
+        time_slot = int(str(body["time_slot"]).split(":")[0])
+        party = {column: int(body.get(column, 0)) for column in PARTY_COLUMNS}
+    except (KeyError, TypeError, ValueError):
+        return "farm_id, customer_id, date, time_slot は必須です", None
+
+    date = _parse_date(body.get("date"))
+    if date is None:
+        return "date は YYYY-MM-DD 形式で指定してください", None
+    if farm_id not in farm_ids:
+        return "指定された農園は存在しません", None
+    if customer_id not in customer_ids:
+        return "指定された顧客は存在しません", None
+    if time_slot not in time_slots:
+        return "time_slot は受付時間帯から指定してください", None
+    if party["adults"] < 1 or min(party.values()) < 0 or sum(party.values()) > MAX_PARTY_SIZE:
+        return f"人数は大人1人以上、合計{MAX_PARTY_SIZE}人以下で指定してください", None
+    return None, (farm_id, customer_id, date, time_slot, party)
+
+
+# API アプリケーションの作成
+# backend は farms, customers, TIME_SLOTS, availability_index_ready, get_availability_index,
+# slot_availability, slot_prices, create_reservation, cancel_reservation を持つ
+def create_api(backend):
+    farm_records = backend.farms[FARM_FIELDS].to_dict("records")
+    farm_ids = {record["id"] for record in farm_records}
+    customer_ids = set(backend.customers["id"].tolist())
+    time_slots = [int(hour) for hour in backend.TIME_SLOTS]
+
+    # 受付上限の索引・料金表が使えない場合は作り直しをスレッドで待つ（イベントループを止めない）
+    async def ensure_index():
+        if not backend.availability_index_ready():
+            await to_thread.run_sync(backend.get_availability_index)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.store_pool = CapacityLimiter(STORE_POOL_SIZE)
+        # 予測・受付上限の索引・料金表を先に用意する
+        await ensure_index()
+        yield
+
+    # 農園検索（location, crop, keyword で絞り込み）
+    async def search_farms(request):
+        location = request.query_params.get("location")
+        crop = request.query_params.get("crop")
+        keyword = request.query_params.get("keyword")
+        results = [
+            record for record in farm_records
+            if (not location or record["location"] == location)
+            and (not crop or record["main_crop"] == crop)
+            and (not keyword or keyword in record["name"])
+        ]
+        return JSONResponse({"farms": results})
+
+    # 指定日の時間帯ごとの残り受付人数と料金
+    async def availability(request):
+        farm_id = int(request.path_params["farm_id"])
+        if farm_id not in farm_ids:
+            return _error(404, "指定された農園は存在しません")
+        date = _parse_date(request.query_params.get("date"))
+        if date is None:
+            return _error(400, "date は YYYY-MM-DD 形式で指定してください")
+
+        await ensure_index()
+        remaining = backend.slot_availability(farm_id, date)
+        prices = backend.slot_prices(farm_id, date)
+        return JSONResponse({
+            "farm_id": farm_id,
+            "date": date.strftime("%Y-%m-%d"),
+            "published": remaining is not None,
+            "slots": [
+                {
+                    "time_slot": format_time_slot(hour),
+                    "remaining": None if remaining is None else int(remaining[i]),
+                    "prices": dict(zip(PARTY_COLUMNS, map(int, prices[i])))
+                }
+                for i, hour in enumerate(time_slots)
+            ]
+        })
+
+    # 予約の登録（満席の場合は 409）
+    async def book(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return _error(400, "リクエスト本文は JSON で指定してください")
+        message, values = _validate_reservation(body, farm_ids, customer_ids, time_slots)
+        if message is not None:
+            return _error(400, message)
+
+        farm_id, customer_id, date, time_slot, party = values
+        # 過去の日付や受付枠の公開期間外の日付は受け付けない
+        await ensure_index()
+        if backend.slot_availability(farm_id, date) is None:
+            return _error(400, "date は受付期間内（翌日以降の受付枠が公開されている日付）で指定してください")
+        # 提示する料金をそのまま予約に記録する
+        unit_prices = backend.slot_prices(farm_id, date)[time_slots.index(time_slot)]
+        reservation_id = await to_thread.run_sync(
+            partial(
+                backend.create_reservation, farm_id, customer_id, date, time_slot, party, unit_prices, source="API"
+            ),
+            limiter=request.app.state.store_pool
+        )
+        if reservation_id is None:
+            return _error(409, "選択した時間帯の受付人数を超えています")
+
+        return JSONResponse({
+            "id": int(reservation_id),
+            "farm_id": farm_id,
+            "date": date.strftime("%Y-%m-%d"),
+            "time_slot": format_time_slot(time_slot),
+            **party,
+            "total": int(sum(party[column] * int(price) for column, price in zip(PARTY_COLUMNS, unit_prices)))
+        }, status_code=201)
+
+    # 予約のキャンセル
+    async def cancel(request):
+        reservation_id = int(request.path_params["reservation_id"])
+        cancelled = await to_thread.run_sync(
+            partial(backend.cancel_reservation, reservation_id, source="API"), limiter=request.app.state.store_pool
+        )
+        if not cancelled:
+            return _error(404, "キャンセルできる予約が見つかりません")
+        return JSONResponse({"id": reservation_id, "status": "キャンセル"})
+
+    return Starlette(
+        routes=[
+            Route("/farms", search_farms),
+            Route("/farms/{farm_id:int}/availability", availability),
+            Route("/reservations", book, methods=["POST"]),
+            Route("/reservations/{reservation_id:int}", cancel, methods=["DELETE"])
+        ],
+        lifespan=lifespan
+    )
+
+
+# backend.py を読み込んで API だけを起動する場合のアプリケーション（uvicorn --factory 用）
+def create_standalone_app():
+    import backend
+    return create_api(backend)
+
+
+# 画面と同じプロセスのバックグラウンドスレッドで API サーバーを起動
+def serve_in_background(asgi_app, port, host="0.0.0.0"):
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="farm-api", daemon=True).start()
+    return server
@@ -7,6 +7,21 @@ import joblib
 from datetime import datetime, timedelta
 import os
 import json
+import hashlib
+
+import backend
+from api import create_api, serve_in_background
+from backend import (
+    FORECAST_FEATURES, PLANNING_HORIZON_DAYS, STAFF_SHIFT_SLOTS, TIME_SLOTS, VISITORS_PER_STAFF, add_to_waitlist,
+    cancel_reservation, create_reservation, customer_preferences, customer_reservations, forecast_visitors,
+    gather_reservations, get_booking_log, get_feature_store, get_occupancy, get_price_table, get_shard,
+    get_slot_capacity, get_waitlist, make_quantile_model, occupancy_for_month, quote_prices, rebuild_from_event_log,
+    region_farm_ids, remaining_capacity, reservation_counts, scatter_gather, shard_revenue, slot_prices, slot_profile,
+    update_cohort_state
+)
+from event_log import compact_event_log, event_history, events_since_snapshot
+
+from schema import decode_preferences, format_time_slot, preference_counts
 
 # ページ設定
 st.set_page_config(
@@ -35,109 +50,17 @@ def load_prediction_model():
         model = RandomForestRegressor()
         return {"model": model, "preprocessor": None, "feature_names": None}
 
-# モックデータの生成
-@st.cache_data
-def generate_mock_data():
-    # 農園データ
-    farms = pd.DataFrame({
-        "id": range(1, 6),
-        "name": ["いちご農園", "りんご農園", "ぶどう農園", "みかん農園", "さくらんぼ農園"],
-        "location": ["東京都", "青森県", "山梨県", "愛媛県", "山形県"],
-        "description": [
-            "東京近郊で楽しめるいちご狩り農園です。30分食べ放題のコースが人気です。",
-            "青森県産の美味しいりんごが収穫できる農園です。秋には様々な品種のりんご狩りが楽しめます。",
-            "山梨県の自然豊かな環境で育ったぶどうの収穫体験ができます。ワイン用品種も栽培しています。",
-            "愛媛県特産のみかん狩りが楽しめる農園です。冬季には温州みかんの収穫体験ができます。",
-            "初夏に旬を迎えるさくらんぼの収穫体験ができます。山形県の特産品を直接味わえます。"
-        ],
-        "main_crop": ["いちご", "りんご", "ぶどう", "みかん", "さくらんぼ"],
-        "harvest_season_start": ["1月", "9月", "8月", "11月", "6月"],
-        "harvest_season_end": ["5月", "11月", "10月", "1月", "7月"],
-        "rating": [4.5, 4.2, 4.7, 4.0, 4.8]
-    })
-    
-    # 予約データ
-    np.random.seed(42)
-    reservations = []
-    for i in range(100):
-        farm_id = np.random.randint(1, 6)
-        date = datetime.now() + timedelta(days=np.random.randint(-30, 30))
-        reservations.append({
-            "id": i + 1,
-            "farm_id": farm_id,
-            "customer_id": np.random.randint(1, 51),
-            "date": date.strftime("%Y-%m-%d"),
-            "time_slot": f"{np.random.randint(9, 16)}:00",
-            "adults": np.random.randint(1, 5),
-            "children": np.random.randint(0, 4),
-            "seniors": np.random.randint(0, 3),
-            "status": np.random.choice(["確定", "キャンセル", "利用済み"], p=[0.7, 0.1, 0.2]),
-            "created_at": (date - timedelta(days=np.random.randint(1, 14))).strftime("%Y-%m-%d")
-        })
-    reservations_df = pd.DataFrame(reservations)
-    
-    # 顧客データ
-    customers = []
-    for i in range(50):
-        age_group = np.random.choice(["20代", "30代", "40代", "50代", "60代以上"], p=[0.1, 0.3, 0.3, 0.2, 0.1])
-        customers.append({
-            "id": i + 1,
-            "name": f"顧客{i+1}",
-            "email": f"customer{i+1}@example.com",
-            "phone": f"090-{np.random.randint(1000, 9999)}-{np.random.randint(1000, 9999)}",
-            "age_group": age_group,
-            "prefecture": np.random.choice(["東京都", "神奈川県", "埼玉県", "千葉県", "その他"], p=[0.3, 0.2, 0.2, 0.2, 0.1]),
-            "first_visit": (datetime.now() - timedelta(days=np.random.randint(0, 365))).strftime("%Y-%m-%d"),
-            "visit_count": np.random.randint(1, 10),
-            "preferences": np.random.choice(["いちご", "りんご", "ぶどう", "みかん", "さくらんぼ"], size=np.random.randint(1, 3)).tolist()
-        })
-    customers_df = pd.DataFrame(customers)
-    
-    # 来客データ
-    visitor_data = []
-    start_date = datetime.now() - timedelta(days=365)
-    for i in range(365):
-        date = start_date + timedelta(days=i)
-        day_of_week = date.weekday()
-        is_weekend = 1 if day_of_week >= 5 else 0
-        is_holiday = np.random.choice([0, 1], p=[0.9, 0.1])
-        
-        # 基本来客数
-        base = 30
-        
-        # 曜日の影響（週末は多い）
-        if is_weekend:
-            base += 40
-        
-        # 祝日の影響
-        if is_holiday:
-            base += 30
-        
-        # 季節の影響
-        month = date.month
-        season_factor = np.sin(month / 12 * 2 * np.pi) * 20 + 20
-        base += season_factor
-        
-        # ランダム変動
-        noise = np.random.normal(0, 10)
-        
-        # 最終来客数（負にならないように）
-        visitors = max(0, int(base + noise))
-        
-        visitor_data.append({
-            "date": date.strftime("%Y-%m-%d"),
-            "day_of_week": day_of_week,
-            "is_weekend": is_weekend,
-            "is_holiday": is_holiday,
-            "month": month,
-            "visitors": visitors
-        })
-    visitor_df = pd.DataFrame(visitor_data)
-    
-    return farms, reservations_df, customers_df, visitor_df
+# データの読み込み（予約・予測の状態は backend がプロセス内で共有する）
+# 画面では表示用の列を追加するため、実行ごとに複製して使う
+farms, customers, visitor_data = backend.farms.copy(), backend.customers.copy(), backend.visitor_data.copy()
 
-# データの読み込み
-farms, reservations, customers, visitor_data = generate_mock_data()
+DEFAULT_REVISIT_DAYS = 90          # 再訪実績がない場合の想定再訪間隔（日）
+BACKTEST_RESULTS_PATH = "backtest_results.json"  # バックテスト結果の保存先
+BACKTEST_FOLDS = 6                 # ウォークフォワード検証の分割数
+BACKTEST_HORIZON_DAYS = 30         # 1分割あたりの検証日数
+INTERVAL_Z = 1.2816                # 予測区間（P10〜P90）に対応する標準正規分位点
+HARVEST_SERVICE_Z = 0.8416         # 収穫量の欠品率を20%に抑える標準正規分位点
+API_PORT_ENV = "FARM_API_PORT"     # 設定されている場合、このポートで予約 API を起動
 
 # ホームページ
 def home_page():
@@ -255,33 +178,37 @@ def farm_list_page():
 def reservation_page():
     st.title("予約管理")
     
-    tabs = st.tabs(["予約一覧", "新規予約", "予約分析"])
+    tabs = st.tabs(["予約一覧", "予約カレンダー", "新規予約", "キャンセル待ち", "予約分析"])
     
     # 予約一覧タブ
     with tabs[0]:
         st.subheader("予約一覧")
         
         # フィルタリング
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
             status_filter = st.selectbox("予約状況", ["すべて", "確定", "キャンセル", "利用済み"])
         with col2:
-            farm_filter = st.selectbox("農園", ["すべて"] + list(farms["name"]))
+            region_filter = st.selectbox("地域", ["すべて"] + sorted(farms["location"].unique()))
         with col3:
+            region_farms = farms if region_filter == "すべて" else farms[farms["location"] == region_filter]
+            farm_filter = st.selectbox("農園", ["すべて"] + list(region_farms["name"]))
+        with col4:
             date_range = st.date_input("期間", [datetime.now() - timedelta(days=30), datetime.now() + timedelta(days=30)])
         
-        # フィルタリング適用
-        filtered_reservations = reservations.copy()
+        # フィルタリング適用（選択した地域・農園のシャードだけを読み込む）
+        if farm_filter != "すべて":
+            selected_farm_ids = region_farms[region_farms["name"] == farm_filter]["id"].tolist()
+        else:
+            selected_farm_ids = region_farms["id"].tolist()
+        filtered_reservations = gather_reservations(selected_farm_ids)
         if status_filter != "すべて":
             filtered_reservations = filtered_reservations[filtered_reservations["status"] == status_filter]
-        if farm_filter != "すべて":
-            farm_id = farms[farms["name"] == farm_filter]["id"].values[0]
-            filtered_reservations = filtered_reservations[filtered_reservations["farm_id"] == farm_id]
         if len(date_range) == 2:
             start_date, end_date = date_range
             filtered_reservations = filtered_reservations[
-                (pd.to_datetime(filtered_reservations["date"]) >= pd.to_datetime(start_date)) &
-                (pd.to_datetime(filtered_reservations["date"]) <= pd.to_datetime(end_date))
+                (filtered_reservations["date"] >= pd.Timestamp(start_date)) &
+                (filtered_reservations["date"] <= pd.Timestamp(end_date))
             ]
         
         # 予約データと農園名、顧客名を結合
@@ -298,12 +225,12 @@ def reservation_page():
         )
         
         # 表示用データフレーム
-        display_df = merged_reservations[[
-            "id", "name_farm", "name_customer", "date", "time_slot", 
+        display_df = _format_reservation_columns(merged_reservations)[[
+            "id", "name", "name_customer", "date", "time_slot", 
             "adults", "children", "seniors", "status"
         ]].rename(columns={
             "id": "予約ID",
-            "name_farm": "農園名",
+            "name": "農園名",
             "name_customer": "顧客名",
             "date": "日付",
             "time_slot": "時間帯",
@@ -314,9 +241,108 @@ def reservation_page():
         })
         
         st.dataframe(display_df, use_container_width=True)
+        
+        # 予約のキャンセル
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            cancel_id = st.number_input("キャンセルする予約ID", min_value=1, step=1)
+        with col2:
+            if st.button("予約をキャンセル"):
+                if cancel_reservation(cancel_id, None if farm_filter == "すべて" else selected_farm_ids[0]):
+                    st.success("予約をキャンセルしました。キャンセル待ちの繰り上げを処理しています。")
+                else:
+                    st.error("キャンセルできる予約が見つかりません")
+        
+        # 操作履歴（イベントログの新しい順）
+        with st.expander("操作履歴"):
+            history_id = st.number_input("予約ID（0の場合はすべて）", min_value=0, step=1, key="history_id")
+            history = event_history(get_booking_log(), history_id or None)
+            st.dataframe(
+                history.merge(farms[["id", "name"]], left_on="farm_id", right_on="id", how="left")[[
+                    "timestamp", "source", "kind", "reservation_id", "name", "customer_id", "status"
+                ]].rename(columns={
+                    "timestamp": "日時",
+                    "source": "操作元",
+                    "kind": "操作",
+                    "reservation_id": "予約ID",
+                    "name": "農園名",
+                    "customer_id": "顧客ID",
+                    "status": "状態"
+                }),
+                use_container_width=True
+            )
     
-    # 新規予約タブ
+    # 予約カレンダータブ
     with tabs[1]:
+        st.subheader("予約カレンダー")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            calendar_farm_id = st.selectbox(
+                "農園",
+                options=farms["id"].tolist(),
+                format_func=lambda x: farms[farms["id"] == x]["name"].values[0],
+                key="calendar_farm"
+            )
+        
+        # 選択した農園のシャードの占有状況だけを参照
+        occupancy = get_occupancy(get_shard(calendar_farm_id))
+        months = pd.period_range(
+            pd.Timestamp(occupancy["start"]),
+            pd.Timestamp(occupancy["start"] + occupancy["counts"].shape[0] - 1),
+            freq="M"
+        )
+        with col2:
+            calendar_month = st.selectbox(
+                "月",
+                options=list(months),
+                index=list(months).index(pd.Period(datetime.now(), freq="M")),
+                format_func=lambda m: f"{m.year}年{m.month}月"
+            )
+        
+        # 選択した農園・月の占有状況（日数 × 時間帯 × 人数区分）
+        month_occupancy = occupancy_for_month(occupancy, calendar_month)
+        daily_people = month_occupancy.sum(axis=(1, 2))
+        
+        # 月間カレンダー（週 × 曜日）
+        st.markdown("### 日別予約人数")
+        cells = [""] * calendar_month.start_time.dayofweek + [
+            f"{day + 1}日 {people}人" for day, people in enumerate(daily_people)
+        ]
+        cells += [""] * (-len(cells) % 7)
+        st.dataframe(
+            pd.DataFrame(np.array(cells).reshape(-1, 7), columns=["月", "火", "水", "木", "金", "土", "日"]),
+            use_container_width=True,
+            hide_index=True
+        )
+        
+        # 時間帯別の予約人数
+        st.markdown("### 時間帯別予約人数")
+        fig, ax = plt.subplots(figsize=(12, 10))
+        sns.heatmap(
+            month_occupancy.sum(axis=2),
+            annot=True,
+            fmt="d",
+            cmap="YlGn",
+            xticklabels=[f"{h}:00" for h in TIME_SLOTS],
+            yticklabels=[f"{day + 1}日" for day in range(len(daily_people))],
+            ax=ax
+        )
+        ax.set_xlabel("時間帯")
+        ax.set_ylabel("日付")
+        st.pyplot(fig)
+        
+        col1, col2, col3 = st.columns(3)
+        party_totals = month_occupancy.sum(axis=(0, 1))
+        with col1:
+            st.metric("大人", f"{party_totals[0]}人")
+        with col2:
+            st.metric("子供", f"{party_totals[1]}人")
+        with col3:
+            st.metric("シニア", f"{party_totals[2]}人")
+    
+    # 新規予約タブ
+    with tabs[2]:
         st.subheader("新規予約")
         
         col1, col2 = st.columns(2)
@@ -345,31 +371,92 @@ def reservation_page():
         with col2:
             # 日時選択
             selected_date = st.date_input("日付を選択", datetime.now() + timedelta(days=1))
-            selected_time = st.selectbox("時間帯を選択", [f"{h}:00" for h in range(9, 17)])
+            selected_time = st.selectbox("時間帯を選択", TIME_SLOTS.tolist(), format_func=format_time_slot)
             
             # 人数選択
             adults = st.number_input("大人", min_value=1, max_value=10, value=2)
             children = st.number_input("子供", min_value=0, max_value=10, value=0)
             seniors = st.number_input("シニア", min_value=0, max_value=10, value=0)
+            
+            # 残り受付人数
+            remaining = remaining_capacity(selected_farm_id, selected_date, selected_time)
+            if remaining is None:
+                st.info(f"この日付は予約を受け付けていません（受付期間は翌日から{PLANNING_HORIZON_DAYS}日間です）")
+            else:
+                st.metric("残り受付人数", f"{remaining}人")
+            
+            # 料金（予測稼働率に応じて変動）
+            unit_prices = quote_prices(selected_farm_id, selected_date, selected_time)
+            st.metric("料金", f"¥{int(np.dot(unit_prices, [adults, children, seniors])):,}")
+            st.caption("1人あたり: 大人 ¥{:,} / 子供 ¥{:,} / シニア ¥{:,}".format(*unit_prices))
         
         # 備考
         notes = st.text_area("備考", "")
         
-        # 予約ボタン
-        if st.button("予約を確定する"):
-            st.success("予約が完了しました！")
-            st.balloons()
+        party = {"adults": adults, "children": children, "seniors": seniors}
+        if remaining is None:
+            st.button("予約を確定する", disabled=True)
+        elif sum(party.values()) > remaining:
+            # 満席の場合はキャンセル待ちを受け付ける
+            st.warning("選択した時間帯は満席です。キャンセル待ちに登録できます。")
+            if st.button("キャンセル待ちに登録する"):
+                add_to_waitlist(selected_farm_id, selected_customer_id, selected_date, selected_time, party)
+                st.success("キャンセル待ちに登録しました。空きが出た場合は自動で予約に繰り上げます。")
+        elif st.button("予約を確定する"):
+            reservation_id = create_reservation(
+                selected_farm_id, selected_customer_id, selected_date, selected_time, party, unit_prices
+            )
+            if reservation_id is None:
+                st.error("選択した時間帯の受付人数を超えています。別の時間帯を選択してください。")
+            else:
+                st.success("予約が完了しました！")
+                st.balloons()
+    
+    # キャンセル待ちタブ
+    with tabs[3]:
+        st.subheader("キャンセル待ち")
+        
+        waitlist = get_waitlist()
+        if len(waitlist) == 0:
+            st.info("キャンセル待ちはありません")
+        else:
+            st.dataframe(
+                _format_reservation_columns(
+                    waitlist.merge(farms[["id", "name"]], left_on="farm_id", right_on="id", suffixes=("", "_farm"))
+                )[[
+                    "id", "name", "customer_id", "date", "time_slot", "adults", "children", "seniors",
+                    "requested_at", "status", "reservation_id"
+                ]].rename(columns={
+                    "id": "受付番号",
+                    "name": "農園名",
+                    "customer_id": "顧客ID",
+                    "date": "日付",
+                    "time_slot": "時間帯",
+                    "adults": "大人",
+                    "children": "子供",
+                    "seniors": "シニア",
+                    "requested_at": "登録日時",
+                    "status": "状態",
+                    "reservation_id": "予約ID"
+                }),
+                use_container_width=True
+            )
     
     # 予約分析タブ
-    with tabs[2]:
+    with tabs[4]:
         st.subheader("予約分析")
         
+        # 地域を選択した場合はその地域の農園のシャードだけを集計
+        analysis_region = st.selectbox("地域", ["すべて"] + sorted(farms["location"].unique()), key="analysis_region")
+        analysis_farm_ids = farms["id"].tolist() if analysis_region == "すべて" else region_farm_ids(analysis_region)
+        analysis_reservations = gather_reservations(analysis_farm_ids)
+        
         col1, col2 = st.columns(2)
         
         with col1:
             # 農園別予約数
             st.markdown("### 農園別予約数")
-            farm_counts = reservations["farm_id"].value_counts().reset_index()
+            farm_counts = analysis_reservations["farm_id"].value_counts().reset_index()
             farm_counts.columns = ["farm_id", "count"]
             farm_counts = farm_counts.merge(farms[["id", "name"]], left_on="farm_id", right_on="id")
             
@@ -383,8 +470,7 @@ def reservation_page():
         with col2:
             # 月別予約数
             st.markdown("### 月別予約数")
-            reservations["month"] = pd.to_datetime(reservations["date"]).dt.month
-            month_counts = reservations["month"].value_counts().sort_index().reset_index()
+            month_counts = analysis_reservations["date"].dt.month.value_counts().sort_index().reset_index()
             month_counts.columns = ["month", "count"]
             month_counts["month_name"] = month_counts["month"].apply(lambda x: f"{x}月")
             
@@ -396,12 +482,56 @@ def reservation_page():
         
         # 予約状況の円グラフ
         st.markdown("### 予約状況")
-        status_counts = reservations["status"].value_counts()
+        status_counts = analysis_reservations["status"].value_counts()
+        status_counts = status_counts[status_counts > 0]
         
         fig, ax = plt.subplots(figsize=(8, 8))
         ax.pie(status_counts, labels=status_counts.index, autopct='%1.1f%%', startangle=90)
         ax.axis('equal')
         st.pyplot(fig)
+        
+        # 月別売上
+        st.markdown("### 月別売上")
+        revenue = get_revenue_aggregates(analysis_farm_ids)
+        monthly_revenue = revenue["monthly"].merge(farms[["id", "name"]], left_on="farm_id", right_on="id")
+        monthly_revenue = monthly_revenue.pivot(index="month", columns="name", values="revenue").fillna(0)
+        st.metric("売上合計", f"¥{int(revenue['daily']['revenue'].sum()):,}")
+        
+        fig, ax = plt.subplots(figsize=(12, 6))
+        monthly_revenue.plot(ax=ax, marker="o")
+        ax.set_xlabel("月")
+        ax.set_ylabel("売上（円）")
+        ax.legend(title="農園")
+        st.pyplot(fig)
+        
+        # 料金表
+        st.markdown("### 料金表")
+        col1, col2 = st.columns(2)
+        with col1:
+            price_farm_id = st.selectbox(
+                "農園",
+                options=farms["id"].tolist(),
+                format_func=lambda x: farms[farms["id"] == x]["name"].values[0],
+                key="price_farm"
+            )
+        with col2:
+            price_date = st.date_input("日付", datetime.now() + timedelta(days=1), key="price_date")
+        
+        st.dataframe(
+            pd.DataFrame(
+                slot_prices(price_farm_id, price_date),
+                index=[format_time_slot(hour) for hour in TIME_SLOTS],
+                columns=["大人", "子供", "シニア"]
+            ),
+            use_container_width=True
+        )
+        
+        if st.button("全農園の料金を再計算"):
+            started = datetime.now()
+            table = get_price_table(refresh=True)
+            elapsed = (datetime.now() - started).total_seconds()
+            n_farms, n_days = table["prices"].shape[:2]
+            st.success(f"{n_farms}農園・{n_days}日分の料金を再計算しました（{elapsed * 1000:.0f} ms）")
 
 # 顧客管理ページ
 def customer_page():
@@ -435,7 +565,7 @@ def customer_page():
             filtered_customers[[
                 "id", "name", "email", "phone", "age_group", 
                 "prefecture", "first_visit", "visit_count"
-            ]].rename(columns={
+            ]].assign(first_visit=filtered_customers["first_visit"].dt.strftime("%Y-%m-%d")).rename(columns={
                 "id": "顧客ID",
                 "name": "氏名",
                 "email": "メールアドレス",
@@ -451,7 +581,8 @@ def customer_page():
         # 顧客詳細表示（クリックで展開）
         customer_id = st.number_input("顧客IDを入力して詳細を表示", min_value=1, max_value=len(customers), step=1)
         if st.button("詳細を表示"):
-            selected_customer = customers[customers["id"] == customer_id].iloc[0]
+            customer_row = np.flatnonzero(customers["id"].values == customer_id)[0]
+            selected_customer = customers.iloc[customer_row]
             
             st.markdown("### 顧客詳細情報")
             col1, col2 = st.columns(2)
@@ -464,12 +595,12 @@ def customer_page():
             
             with col2:
                 st.write(f"**都道府県**: {selected_customer['prefecture']}")
-                st.write(f"**初回訪問日**: {selected_customer['first_visit']}")
+                st.write(f"**初回訪問日**: {selected_customer['first_visit']:%Y-%m-%d}")
                 st.write(f"**訪問回数**: {selected_customer['visit_count']}")
-                st.write(f"**好みの作物**: {', '.join(selected_customer['preferences'])}")
+                st.write(f"**好みの作物**: {', '.join(decode_preferences(customer_preferences, customer_row))}")
             
             # 予約履歴
-            customer_reservations = reservations[reservations["customer_id"] == customer_id].merge(
+            history = customer_reservations(customer_id).merge(
                 farms[["id", "name"]], 
                 left_on="farm_id", 
                 right_on="id", 
@@ -477,13 +608,13 @@ def customer_page():
             )
             
             st.markdown("### 予約履歴")
-            if len(customer_reservations) > 0:
+            if len(history) > 0:
                 st.dataframe(
-                    customer_reservations[[
-                        "date", "name_farm", "time_slot", "adults", "children", "seniors", "status"
+                    _format_reservation_columns(history)[[
+                        "date", "name", "time_slot", "adults", "children", "seniors", "status"
                     ]].rename(columns={
                         "date": "日付",
-                        "name_farm": "農園名",
+                        "name": "農園名",
                         "time_slot": "時間帯",
                         "adults": "大人",
                         "children": "子供",
@@ -538,11 +669,7 @@ def customer_page():
         st.markdown("### 作物の好み分布")
         
         # 好みの作物をカウント
-        crop_preferences = []
-        for prefs in customers["preferences"]:
-            crop_preferences.extend(prefs)
-        
-        crop_counts = pd.Series(crop_preferences).value_counts().reset_index()
+        crop_counts = preference_counts(customer_preferences).sort_values(ascending=False).reset_index()
         crop_counts.columns = ["crop", "count"]
         
         fig, ax = plt.subplots(figsize=(10, 6))
@@ -550,6 +677,59 @@ def customer_page():
         ax.set_xlabel("作物")
         ax.set_ylabel("好む顧客数")
         st.pyplot(fig)
+        
+        # コホート分析（完了した月まで集計済みの結果を使用）
+        cohort_state = update_cohort_state()
+        analytics = cohort_analytics(cohort_state["version"], datetime.now().date(), cohort_state)
+        
+        st.markdown("### 初回訪問月別のリピート率")
+        st.caption(f"{cohort_state['processed_until'].year}年{cohort_state['processed_until'].month}月までの予約を集計")
+        
+        fig, ax = plt.subplots(figsize=(12, 8))
+        sns.heatmap(analytics["retention"] * 100, annot=True, fmt=".0f", cmap="Blues", vmin=0, vmax=100, ax=ax)
+        ax.set_xlabel("初回訪問からの経過月数")
+        ax.set_ylabel("初回訪問月")
+        st.pyplot(fig)
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            # 再訪間隔
+            st.markdown("### 平均再訪間隔")
+            
+            fig, ax = plt.subplots(figsize=(10, 6))
+            sns.histplot(analytics["customers"]["interval_days"].dropna(), bins=10, ax=ax)
+            ax.set_xlabel("平均再訪間隔（日）")
+            ax.set_ylabel("顧客数")
+            st.pyplot(fig)
+        
+        with col2:
+            # 離反リスク
+            st.markdown("### 離反リスク")
+            risk_counts = analytics["customers"]["churn_level"].value_counts().reindex(["低", "中", "高"], fill_value=0).reset_index()
+            risk_counts.columns = ["churn_level", "count"]
+            
+            fig, ax = plt.subplots(figsize=(10, 6))
+            sns.barplot(x="churn_level", y="count", data=risk_counts, ax=ax)
+            ax.set_xlabel("離反リスク")
+            ax.set_ylabel("顧客数")
+            st.pyplot(fig)
+        
+        st.markdown("### 離反リスクの高い顧客")
+        at_risk = analytics["customers"].sort_values("churn_risk", ascending=False).head(10).merge(
+            customers[["id", "name"]], left_on="customer_id", right_on="id"
+        )
+        st.dataframe(
+            at_risk[["customer_id", "name", "visits", "last_visit", "interval_days", "churn_risk"]].rename(columns={
+                "customer_id": "顧客ID",
+                "name": "氏名",
+                "visits": "訪問回数",
+                "last_visit": "最終訪問日",
+                "interval_days": "平均再訪間隔（日）",
+                "churn_risk": "離反リスク"
+            }).round(2),
+            use_container_width=True
+        )
     
     # セグメント分析タブ
     with tabs[2]:
@@ -561,9 +741,11 @@ def customer_page():
         RFM分析は以下の3つの指標に基づいて顧客をセグメント化する手法です：
         - **Recency（最新性）**: 最後の訪問からの経過時間
         - **Frequency（頻度）**: 訪問回数
-        - **Monetary（金額）**: 支出金額（このデモでは訪問回数で代用）
+        - **Monetary（金額）**: 予約の利用金額の合計（キャンセルを除く）
         """)
         
+        customers["monetary"] = get_revenue_aggregates()["customer"].reindex(customers["id"], fill_value=0).values
+        
         # 訪問回数でセグメント化
         customers["segment"] = pd.cut(
             customers["visit_count"], 
@@ -580,6 +762,16 @@ def customer_page():
         ax.set_ylabel("顧客数")
         st.pyplot(fig)
         
+        # セグメント別の平均利用金額
+        st.markdown("### セグメント別平均利用金額")
+        segment_monetary = customers.groupby("segment", observed=False)["monetary"].mean().reset_index()
+        
+        fig, ax = plt.subplots(figsize=(10, 6))
+        sns.barplot(x="segment", y="monetary", data=segment_monetary, ax=ax)
+        ax.set_xlabel("顧客セグメント")
+        ax.set_ylabel("平均利用金額（円）")
+        st.pyplot(fig)
+        
         # セグメント別の特性
         st.markdown("### セグメント別特性")
         
@@ -673,41 +865,7 @@ def prediction_page():
         # 予測の実行
         if st.button("予測を実行"):
             with st.spinner("予測を計算中..."):
-                # 予測データの生成（モックデータ）
-                future_dates = [datetime.now() + timedelta(days=i) for i in range(1, prediction_days+1)]
-                predictions = []
-                
-                for date in future_dates:
-                    day_of_week = date.weekday()
-                    is_weekend = 1 if day_of_week >= 5 else 0
-                    
-                    # 基本来客数
-                    base = 30
-                    
-                    # 曜日の影響（週末は多い）
-                    if is_weekend:
-                        base += 40
-                    
-                    # 季節の影響
-                    month = date.month
-                    season_factor = np.sin(month / 12 * 2 * np.pi) * 20 + 20
-                    base += season_factor
-                    
-                    # ランダム変動
-                    noise = np.random.normal(0, 5)
-                    
-                    # 最終来客数
-                    visitors = max(0, int(base + noise))
-                    
-                    predictions.append({
-                        "date": date.strftime("%Y-%m-%d"),
-                        "day_of_week": day_of_week,
-                        "is_weekend": is_weekend,
-                        "month": month,
-                        "predicted_visitors": visitors
-                    })
-                
-                predictions_df = pd.DataFrame(predictions)
+                predictions_df = forecast_visitors(prediction_days)
                 predictions_df["date_obj"] = pd.to_datetime(predictions_df["date"])
                 predictions_df["day_name"] = predictions_df["day_of_week"].map(day_names)
             
@@ -716,9 +874,17 @@ def prediction_page():
             
             # 日別予測グラフ
             fig, ax = plt.subplots(figsize=(12, 6))
-            sns.lineplot(x="date_obj", y="predicted_visitors", data=predictions_df, ax=ax)
+            ax.fill_between(
+                predictions_df["date_obj"],
+                predictions_df["lower_visitors"],
+                predictions_df["upper_visitors"],
+                alpha=0.3,
+                label="予測区間（P10〜P90）"
+            )
+            sns.lineplot(x="date_obj", y="predicted_visitors", data=predictions_df, ax=ax, label="予測来客数（P50）")
             ax.set_xlabel("日付")
             ax.set_ylabel("予測来客数")
+            ax.legend()
             st.pyplot(fig)
             
             # 曜日別予測グラフ
@@ -731,6 +897,12 @@ def prediction_page():
                 data=predictions_df, 
                 ax=ax
             )
+            ax.vlines(
+                range(len(predictions_df)),
+                predictions_df["lower_visitors"],
+                predictions_df["upper_visitors"],
+                color="gray"
+            )
             ax.set_xlabel("日付")
             ax.set_ylabel("予測来客数")
             ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha="right")
@@ -740,14 +912,32 @@ def prediction_page():
             # 予測データテーブル
             st.markdown("### 予測データ")
             st.dataframe(
-                predictions_df[["date", "day_name", "predicted_visitors"]].rename(columns={
+                predictions_df[["date", "day_name", "predicted_visitors", "lower_visitors", "upper_visitors"]].rename(columns={
                     "date": "日付",
                     "day_name": "曜日",
-                    "predicted_visitors": "予測来客数"
-                }),
+                    "predicted_visitors": "予測来客数",
+                    "lower_visitors": "下限（P10）",
+                    "upper_visitors": "上限（P90）"
+                }).round(1),
                 use_container_width=True
             )
             
+            # 時間帯別受付人数
+            st.markdown("### 時間帯別受付人数")
+            
+            published = get_slot_capacity()
+            st.caption(f"予測が変化した {published['updated']} 件の農園・日付の受付枠を更新しました")
+            
+            farm_tabs = st.tabs(farms["name"].tolist())
+            for farm_index, farm_tab in enumerate(farm_tabs):
+                with farm_tab:
+                    capacity_df = pd.DataFrame(
+                        published["capacity"][farm_index, :prediction_days],
+                        index=published["dates"][:prediction_days],
+                        columns=[f"{h}:00" for h in TIME_SLOTS]
+                    )
+                    st.dataframe(capacity_df, use_container_width=True)
+            
             # 運営提案
             st.markdown("### 運営提案")
             
@@ -763,6 +953,20 @@ def prediction_page():
             # 平日の平均来客数
             weekday_avg = predictions_df[predictions_df["is_weekend"] == 0]["predicted_visitors"].mean()
             
+            # 全農園のシフトと収穫量を一括で最適化（予測バージョンごとにキャッシュ）
+            operations = plan_operations(published["version"], published)
+            staff_by_day = operations["staff"][:, :prediction_days].sum(axis=0)
+            is_weekend = predictions_df["is_weekend"].values == 1
+            
+            if is_weekend.any() and (~is_weekend).any() and staff_by_day[~is_weekend].mean() > 0:
+                weekday_staff = staff_by_day[~is_weekend].mean()
+                weekend_staff = staff_by_day[is_weekend].mean()
+                ratio_text = f"休日は平日の約 {(weekend_avg/weekday_avg):.1f}倍の来客があります。" if weekday_avg > 0 else "平日の来客は見込まれていません。"
+                staff_text = f"平日 {weekday_staff:.1f}人/日、休日 {weekend_staff:.1f}人/日（{(weekend_staff/weekday_staff - 1) * 100:+.0f}%）"
+            else:
+                ratio_text = "予測期間に平日と休日の両方が含まれていません。"
+                staff_text = f"{staff_by_day.mean():.1f}人/日"
+            
             st.markdown(f"""
             #### 来客予測に基づく運営提案
             
@@ -772,31 +976,44 @@ def prediction_page():
             2. **平均来客数**: {avg_visitors:.1f}人/日
                - 平日平均: {weekday_avg:.1f}人
                - 休日平均: {weekend_avg:.1f}人
-               - 休日は平日の約 {(weekend_avg/weekday_avg):.1f}倍の来客があります。
+               - {ratio_text}
             
-            3. **スタッフ配置の提案**:
-               - 平日: 基本スタッフ配置
-               - 休日: スタッフを {int((weekend_avg/weekday_avg) * 100 - 100)}% 増員
+            3. **スタッフ配置の提案**（予測区間の上限に対応できる人数）:
+               - 全農園合計: {staff_text}
             
             4. **収穫量の調整**:
-               - 休日前には収穫量を増やし、平日は通常量に調整することで、
-                 鮮度の良い状態で提供できる量を最適化できます。
+               - 予測区間を考慮し、欠品が2割以下になる量を農園ごとに算出しています。
             """)
+            
+            operations_df = operations_table(operations, published, prediction_days)
+            shortage = operations_df[operations_df["スタッフ不足"] > 0]
+            if len(shortage) > 0:
+                st.warning(f"{len(shortage)}件の農園・日付でスタッフが不足しています")
+            st.dataframe(operations_df, use_container_width=True)
     
     # 予測モデル分析タブ
     with tabs[2]:
         st.subheader("予測モデル分析")
         
+        # バックテスト結果の読み込み（保存済みの結果を表示）
+        backtest = load_backtest_results()
+        if st.button("バックテストを実行"):
+            with st.spinner("ウォークフォワード検証を実行中..."):
+                backtest = run_backtest()
+        
+        if backtest is None:
+            st.info("バックテスト結果がありません。「バックテストを実行」を押して作成してください。")
+            return
+        
+        st.caption(f"{backtest['generated_at']} 実行 / {len(backtest['folds'])} 分割のウォークフォワード検証")
+        if backtest["data_version"] != _visitor_data_version():
+            st.warning("バックテスト結果は最新の来客データに基づいていません。再実行してください。")
+        
         # 特徴量の重要度
         st.markdown("### 特徴量の重要度")
         
-        # モックデータでの特徴量重要度
-        feature_importance = pd.DataFrame({
-            "feature": ["day_of_week", "month", "has_event", "is_harvest_season", "is_holiday", 
-                       "weather_rainy", "weather_sunny", "recent_visitors", "precipitation_prob", "temperature"],
-            "importance": [0.345071, 0.158490, 0.157509, 0.130171, 0.079866, 
-                          0.039845, 0.021621, 0.014993, 0.014450, 0.013893]
-        })
+        # 検証期間での並べ替え重要度（MAEの悪化量）
+        feature_importance = pd.DataFrame(backtest["feature_importance"]).sort_values("importance", ascending=False)
         
         fig, ax = plt.subplots(figsize=(10, 6))
         sns.barplot(x="importance", y="feature", data=feature_importance, ax=ax)
@@ -804,40 +1021,32 @@ def prediction_page():
         ax.set_ylabel("特徴量")
         st.pyplot(fig)
         
-        # 特徴量の説明
-        st.markdown("""
-        ### 特徴量の解説
-        
-        1. **day_of_week（曜日）**: 最も重要な特徴量です。週末（土日）は平日に比べて来客数が大幅に増加します。
-        
-        2. **month（月）**: 季節による来客数の変動を表します。春や秋のシーズンは来客数が増加する傾向があります。
-        
-        3. **has_event（イベントの有無）**: 収穫祭などのイベント開催日は通常よりも来客数が増加します。
-        
-        4. **is_harvest_season（収穫時期）**: 作物の収穫最盛期には来客数が増加します。
-        
-        5. **is_holiday（祝日）**: 祝日は平日であっても来客数が増加します。
-        
-        6. **weather_rainy（雨天）**: 雨天時は来客数が減少する傾向があります。
-        
-        7. **weather_sunny（晴天）**: 晴天時は来客数がやや増加します。
-        
-        8. **recent_visitors（最近の来客数）**: 直近の来客傾向も将来の来客数に影響します。
-        
-        9. **precipitation_prob（降水確率）**: 降水確率が高いと来客数が減少する傾向があります。
-        
-        10. **temperature（気温）**: 気温も来客数に影響しますが、その影響は比較的小さいです。
-        """)
+        # 特徴量の説明（バックテストの重要度の高い順）
+        feature_descriptions = {
+            "day_of_week": "曜日。週末（土日）は平日に比べて来客数が増加します。",
+            "is_weekend": "週末かどうか。",
+            "month": "季節による来客数の変動を表します。",
+            "has_event": "収穫祭などのイベント開催日かどうか。",
+            "is_harvest_season": "作物の収穫時期かどうか。",
+            "farm_share": "全体の来客数に占める農園の比率（予約実績と収穫時期から推定）。",
+            "is_holiday": "祝日かどうか。祝日は平日であっても来客数が増加します。",
+            "weather_rainy": "雨天かどうか。",
+            "weather_sunny": "晴天かどうか。",
+            "recent_visitors": "直近の来客数の移動平均。",
+            "precipitation_prob": "降水確率。",
+            "temperature": "気温。"
+        }
+        st.markdown("### 特徴量の解説")
+        st.markdown("\n".join(
+            f"{rank}. **{row.feature}**（重要度 {row.importance * 100:.0f}%）: {feature_descriptions.get(row.feature, '')}"
+            for rank, row in enumerate(feature_importance.itertuples(), start=1)
+        ))
         
         # 予測精度の評価
         st.markdown("### 予測モデルの精度")
         
-        # モックデータでの評価指標
-        evaluation = {
-            "mae": 10.40,
-            "rmse": 13.18,
-            "r2": 0.83
-        }
+        # 全分割の検証期間をまとめた評価指標
+        evaluation = backtest["evaluation"]
         
         col1, col2, col3 = st.columns(3)
         
@@ -853,14 +1062,26 @@ def prediction_page():
             st.metric("R²", f"{evaluation['r2']:.2f}")
             st.markdown("決定係数（Coefficient of Determination）")
         
-        st.markdown("""
+        # 分割ごとの評価指標
+        st.dataframe(
+            pd.DataFrame(backtest["folds"]).rename(columns={
+                "train_end": "学習期間の終了日",
+                "test_end": "検証期間の終了日",
+                "mae": "MAE",
+                "rmse": "RMSE",
+                "r2": "R²"
+            }).round(2),
+            use_container_width=True
+        )
+        
+        st.markdown(f"""
         ### 精度評価の解説
         
         - **MAE（平均絶対誤差）**: 予測値と実際の値の差の絶対値の平均です。この値が小さいほど予測精度が高いことを示します。
         
         - **RMSE（平方根平均二乗誤差）**: 予測値と実際の値の差の二乗の平均の平方根です。外れ値に敏感な指標で、この値が小さいほど予測精度が高いことを示します。
         
-        - **R²（決定係数）**: モデルがデータの変動をどれだけ説明できるかを示す指標です。1に近いほど予測精度が高いことを示します。0.83という値は、モデルがデータの変動の83%を説明できることを意味し、高い精度と言えます。
+        - **R²（決定係数）**: モデルがデータの変動をどれだけ説明できるかを示す指標です。1に近いほど予測精度が高いことを示します。{evaluation['r2']:.2f}という値は、モデルがデータの変動の{evaluation['r2'] * 100:.0f}%を説明できることを意味します。
         """)
 
 # システム情報ページ
@@ -921,7 +1142,26 @@ def system_info_page():
         st.metric("登録顧客数", len(customers))
     
     with col3:
-        st.metric("予約総数", len(reservations))
+        st.metric("予約総数", int(reservation_counts().sum()))
+    
+    # イベントログ
+    st.subheader("予約イベントログ")
+    log = get_booking_log()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("イベント総数", f"{log['next_sequence']:,}")
+    with col2:
+        st.metric("スナップショット以降のイベント数", f"{events_since_snapshot(log):,}")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("イベントログから再構築"):
+            replayed, elapsed = rebuild_from_event_log()
+            st.success(f"{replayed:,}件のイベントを再生して予約データを再構築しました（{elapsed * 1000:.0f} ms）")
+    with col2:
+        if st.button("スナップショットを作成"):
+            sequence = compact_event_log(log)
+            st.success(f"イベント{sequence:,}件目までのスナップショットを作成しました")
     
     # 利用方法
     st.subheader("利用方法")
@@ -959,6 +1199,225 @@ def _is_current_month_in_season(start_month, end_month):
     else:  # 年をまたぐ場合（例：11月〜2月）
         return current_month >= start or current_month <= end
 
+# 来客データのバージョン（内容のハッシュ）
+def _visitor_data_version():
+    return hashlib.sha1(pd.util.hash_pandas_object(visitor_data[["date", "visitors"]], index=False).values.tobytes()).hexdigest()[:12]
+
+# 分割ごとの学習・検証用の特徴量行列
+# 検証期間の直近来客数は、予測時と同じく学習期間の最終値で固定する
+def _fold_features(features, target, farm_index, day_index, train_end, test_end):
+    train = day_index < train_end
+    test = (day_index >= train_end) & (day_index < test_end)
+    recent_column = FORECAST_FEATURES.index("recent_visitors")
+    
+    X_test = features[test].copy()
+    recent_at_origin = np.zeros(farm_index.max() + 1)
+    origin_rows = day_index == train_end
+    recent_at_origin[farm_index[origin_rows]] = features[origin_rows, recent_column]
+    X_test[:, recent_column] = recent_at_origin[farm_index[test]]
+    return features[train], target[train], X_test, target[test]
+
+# 1分割分の学習と検証（P50モデルの予測値と並べ替え重要度）
+def _backtest_fold(features, target, farm_index, day_index, train_end, test_end):
+    from sklearn.inspection import permutation_importance
+    X_train, y_train, X_test, y_test = _fold_features(features, target, farm_index, day_index, train_end, test_end)
+    model = make_quantile_model(0.5).fit(X_train, y_train)
+    importance = permutation_importance(
+        model, X_test, y_test, scoring="neg_mean_absolute_error", n_repeats=10, random_state=42
+    )
+    return y_test, model.predict(X_test), importance.importances_mean
+
+# 評価指標（MAE/RMSE/R²）
+def _evaluate(actual, predicted):
+    error = actual - predicted
+    total = ((actual - actual.mean()) ** 2).sum()
+    return {
+        "mae": float(np.abs(error).mean()),
+        "rmse": float(np.sqrt((error ** 2).mean())),
+        "r2": float(1 - (error ** 2).sum() / total) if total > 0 else 0.0
+    }
+
+# ウォークフォワード検証（学習期間を伸ばしながら直後の期間を予測）
+def run_backtest():
+    store = get_feature_store()
+    history = store[store["visitors"].notna()]
+    features = history[FORECAST_FEATURES].to_numpy(dtype=float)
+    target = history["visitors"].to_numpy(dtype=float)
+    farm_index = history["farm_id"].map({farm_id: i for i, farm_id in enumerate(farms["id"])}).to_numpy()
+    history_dates = np.sort(history["date"].unique())
+    day_index = np.searchsorted(history_dates, history["date"].values)
+    
+    n_days = len(history_dates)
+    origins = [n_days - BACKTEST_HORIZON_DAYS * k for k in range(BACKTEST_FOLDS, 0, -1)]
+    
+    results = joblib.Parallel(n_jobs=-1)(
+        joblib.delayed(_backtest_fold)(
+            features, target, farm_index, day_index, origin, origin + BACKTEST_HORIZON_DAYS
+        )
+        for origin in origins
+    )
+    
+    folds = []
+    for origin, (actual, predicted, _) in zip(origins, results):
+        folds.append({
+            "train_end": pd.Timestamp(history_dates[origin - 1]).strftime("%Y-%m-%d"),
+            "test_end": pd.Timestamp(history_dates[origin + BACKTEST_HORIZON_DAYS - 1]).strftime("%Y-%m-%d"),
+            **_evaluate(actual, predicted)
+        })
+    
+    importance = np.maximum(0, np.mean([result[2] for result in results], axis=0))
+    if importance.sum() > 0:
+        importance = importance / importance.sum()
+    
+    backtest = {
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "data_version": _visitor_data_version(),
+        "evaluation": _evaluate(
+            np.concatenate([result[0] for result in results]),
+            np.concatenate([result[1] for result in results])
+        ),
+        "folds": folds,
+        "feature_importance": {"feature": FORECAST_FEATURES, "importance": importance.tolist()}
+    }
+    with open(BACKTEST_RESULTS_PATH, "w", encoding="utf-8") as f:
+        json.dump(backtest, f, ensure_ascii=False, indent=2)
+    return backtest
+
+# 保存済みのバックテスト結果（存在しない場合は None）
+def load_backtest_results():
+    if not os.path.exists(BACKTEST_RESULTS_PATH):
+        return None
+    with open(BACKTEST_RESULTS_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+# 農園ごとの日別・月別売上と顧客ごとの利用金額
+# 対象シャードで並列に計算し、シャードごとの変更回数ごとにキャッシュ
+@st.cache_data
+def revenue_aggregates(farm_ids, revisions):
+    revenue = pd.concat(scatter_gather(shard_revenue, farm_ids).values(), ignore_index=True)
+    daily = revenue.groupby(["farm_id", "date"], as_index=False)["revenue"].sum()
+    monthly = daily.assign(month=daily["date"].dt.to_period("M")).groupby(
+        ["farm_id", "month"], as_index=False
+    )["revenue"].sum()
+    return {
+        "daily": daily,
+        "monthly": monthly,
+        "customer": revenue.groupby("customer_id")["revenue"].sum()
+    }
+
+# 最新の予約に基づく売上集計（指定した農園のシャードのみ、省略時は全農園）
+def get_revenue_aggregates(farm_ids=None):
+    farm_ids = tuple(farms["id"].tolist() if farm_ids is None else farm_ids)
+    revisions = tuple(get_shard(farm_id)["revision"] for farm_id in farm_ids)
+    return revenue_aggregates(farm_ids, revisions)
+
+# 時間帯ごとの必要スタッフ数を満たす連続シフトの開始人数（セル数 × 時間帯数）
+# 不足が出た時間帯からシフトを始める貪欲法で、必要な延べ人数を最小化する
+def _plan_shifts(required):
+    n_slots = required.shape[1]
+    starts = np.zeros_like(required)
+    coverage = np.zeros_like(required)
+    for slot in range(n_slots):
+        short = np.maximum(0, required[:, slot] - coverage[:, slot])
+        start = min(slot, n_slots - STAFF_SHIFT_SLOTS)
+        starts[:, start] += short
+        coverage[:, start:start + STAFF_SHIFT_SLOTS] += short[:, None]
+    return starts
+
+# 全農園・全日付のシフトと収穫量を最適化（予測バージョンごとにキャッシュ）
+@st.cache_data
+def plan_operations(forecast_version, _published):
+    n_farms, n_days = _published["forecast"].shape
+    
+    # 予測区間の上限に対応できる人数を、受付枠を上限として配置
+    slot_upper = _published["upper"][:, :, None] * slot_profile()[None, None, :]
+    slot_demand = np.minimum(_published["capacity"], slot_upper)
+    required = np.ceil(slot_demand / VISITORS_PER_STAFF).astype(np.int32).reshape(n_farms * n_days, -1)
+    shift_starts = _plan_shifts(required).reshape(n_farms, n_days, -1)
+    staff = shift_starts.sum(axis=2)
+    
+    # 予測区間を正規分布とみなした新聞売り子問題の解で収穫量を決定
+    sigma = (_published["upper"] - _published["lower"]) / (2 * INTERVAL_Z)
+    harvest_visitors = np.maximum(0, _published["forecast"] + HARVEST_SERVICE_Z * sigma)
+    harvest_kg = harvest_visitors * farms["harvest_kg_per_visitor"].values[:, None]
+    
+    return {
+        "shift_starts": shift_starts,
+        "staff": staff,
+        "shortage": np.maximum(0, staff - farms["staff_count"].values[:, None]),
+        "harvest_kg": harvest_kg
+    }
+
+# 運営計画の表示用データフレーム
+def operations_table(operations, published, prediction_days):
+    rows = []
+    for farm_index, farm_name in enumerate(farms["name"]):
+        for day_index in range(min(prediction_days, len(published["dates"]))):
+            starts = operations["shift_starts"][farm_index, day_index]
+            rows.append({
+                "日付": published["dates"][day_index],
+                "農園名": farm_name,
+                "必要スタッフ数": int(operations["staff"][farm_index, day_index]),
+                "シフト開始": ", ".join(f"{TIME_SLOTS[i]}:00×{n}" for i, n in enumerate(starts) if n > 0),
+                "スタッフ不足": int(operations["shortage"][farm_index, day_index]),
+                "収穫量(kg)": round(float(operations["harvest_kg"][farm_index, day_index]), 1)
+            })
+    return pd.DataFrame(rows)
+
+# コホート別リピート率と顧客ごとの再訪間隔・離反リスク（集計状態のバージョンと日付ごとにキャッシュ）
+@st.cache_data
+def cohort_analytics(version, today, _state):
+    cohort_month = customers["first_visit"].values.astype("datetime64[M]")
+    cohort_index = (cohort_month - np.datetime64(str(_state["start_month"]), "M")).astype(int)
+    n_months = _state["active"].shape[1]
+    
+    # 初回訪問月を0か月目として、n か月目に訪問した顧客の割合
+    retention = np.full((n_months, n_months), np.nan)
+    for cohort in range(n_months):
+        members = cohort_index == cohort
+        if not members.any():
+            continue
+        offsets = n_months - cohort
+        retention[cohort, :offsets] = _state["active"][members, cohort:].mean(axis=0)
+        retention[cohort, 0] = 1.0
+    labels = pd.period_range(_state["start_month"], periods=n_months, freq="M").strftime("%Y-%m")
+    retention_df = pd.DataFrame(retention, index=labels, columns=range(n_months)).dropna(how="all")
+    
+    # 平均再訪間隔と、最終訪問からの経過日数に基づく離反リスク
+    visits = _state["visits"]
+    span = (_state["last_seen"] - _state["first_seen"]).astype(int)
+    interval = np.where(visits > 1, span / np.maximum(visits - 1, 1), np.nan)
+    expected = np.where(np.isnan(interval), np.nanmedian(interval) if (visits > 1).any() else DEFAULT_REVISIT_DAYS, interval)
+    since_last = (np.datetime64(today) - _state["last_seen"]).astype(int)
+    churn_risk = 1 - np.exp(-np.maximum(since_last, 0) / np.maximum(expected, 1))
+    
+    customer_df = pd.DataFrame({
+        "customer_id": _state["customer_ids"],
+        "visits": visits,
+        "last_visit": pd.to_datetime(_state["last_seen"]).strftime("%Y-%m-%d"),
+        "interval_days": interval,
+        "churn_risk": churn_risk,
+        "churn_level": pd.cut(churn_risk, bins=[-0.01, 0.5, 0.8, 1.0], labels=["低", "中", "高"])
+    })
+    return {"retention": retention_df, "customers": customer_df}
+
+# 表示用に日付と時間帯を文字列に変換
+def _format_reservation_columns(df):
+    return df.assign(
+        date=pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d"),
+        time_slot=df["time_slot"].map(format_time_slot)
+    )
+
+# 提携サイト向け予約 API（backend の予約ストア・索引・料金表を画面と共有、プロセスごとに1回だけ起動）
+@st.cache_resource
+def _api_server():
+    port = os.environ.get(API_PORT_ENV)
+    if not port:
+        return None
+    return serve_in_background(create_api(backend), int(port))
+
+_api_server()
+
 # メイン処理
 if page == "ホーム":
     home_page()
@@ -0,0 +1,1028 @@
+# 予約・予測のバックエンド（画面 app.py と予約 API api.py が共有する）
+#
+# - 予約ストア（イベントログ・農園ごとのシャード）、特徴量ストア、受付枠、受付上限の索引、料金表、
+#   コホート集計の状態は、モジュールに1つだけ持つ（プロセス内の全セッション・全スレッドで共有）
+# - 状態の更新はそれぞれのロックで直列化する
+# - Streamlit に依存しないため、API だけを起動する場合（uvicorn）やテストからも読み込める
+import functools
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import os
+
+import numpy as np
+import pandas as pd
+
+from event_log import (
+    EVENT_CREATED, EVENT_STATUS, append_events, compact_event_log, events_from_reservations, events_since_snapshot,
+    load_state, make_events, max_reservation_id, open_event_log, state_to_frame
+)
+from schema import PARTY_COLUMNS, PRICE_COLUMNS, RESERVATION_STATUSES, compact_customers, compact_reservations
+
+# 祝日（月-日、祝日ファイルがない場合に使用）
+JAPANESE_HOLIDAYS = [
+    "01-01", "02-11", "02-23", "03-20", "04-29", "05-03", "05-04", "05-05",
+    "08-11", "09-23", "11-03", "11-23"
+]
+
+# モックデータの生成（プロセスごとに1回だけ生成）
+@functools.lru_cache(maxsize=None)
+def generate_mock_data():
+    # 農園データ
+    farms = pd.DataFrame({
+        "id": range(1, 6),
+        "name": ["いちご農園", "りんご農園", "ぶどう農園", "みかん農園", "さくらんぼ農園"],
+        "location": ["東京都", "青森県", "山梨県", "愛媛県", "山形県"],
+        "description": [
+            "東京近郊で楽しめるいちご狩り農園です。30分食べ放題のコースが人気です。",
+            "青森県産の美味しいりんごが収穫できる農園です。秋には様々な品種のりんご狩りが楽しめます。",
+            "山梨県の自然豊かな環境で育ったぶどうの収穫体験ができます。ワイン用品種も栽培しています。",
+            "愛媛県特産のみかん狩りが楽しめる農園です。冬季には温州みかんの収穫体験ができます。",
+            "初夏に旬を迎えるさくらんぼの収穫体験ができます。山形県の特産品を直接味わえます。"
+        ],
+        "main_crop": ["いちご", "りんご", "ぶどう", "みかん", "さくらんぼ"],
+        "harvest_season_start": ["1月", "9月", "8月", "11月", "6月"],
+        "harvest_season_end": ["5月", "11月", "10月", "1月", "7月"],
+        "rating": [4.5, 4.2, 4.7, 4.0, 4.8],
+        "staff_count": [6, 4, 5, 3, 4],
+        "field_capacity": [40, 30, 35, 25, 30],
+        "harvest_kg_per_visitor": [0.5, 1.5, 1.0, 1.2, 0.3],
+        "adult_price": [2000, 1500, 2200, 1200, 3000],
+        "child_price": [1200, 900, 1300, 700, 1800],
+        "senior_price": [1800, 1300, 2000, 1000, 2700]
+    })
+    
+    # 予約データ
+    np.random.seed(42)
+    reservations = []
+    for i in range(100):
+        farm_id = np.random.randint(1, 6)
+        date = datetime.now() + timedelta(days=np.random.randint(-30, 30))
+        reservations.append({
+            "id": i + 1,
+            "farm_id": farm_id,
+            "customer_id": np.random.randint(1, 51),
+            "date": date.strftime("%Y-%m-%d"),
+            "time_slot": f"{np.random.randint(9, 16)}:00",
+            "adults": np.random.randint(1, 5),
+            "children": np.random.randint(0, 4),
+            "seniors": np.random.randint(0, 3),
+            "status": np.random.choice(["確定", "キャンセル", "利用済み"], p=[0.7, 0.1, 0.2]),
+            "created_at": (date - timedelta(days=np.random.randint(1, 14))).strftime("%Y-%m-%d")
+        })
+    reservations_df = pd.DataFrame(reservations)
+    # 初期データの予約時の料金は農園の基本料金とする
+    reservations_df[PRICE_COLUMNS] = farms.set_index("id").loc[reservations_df["farm_id"], PRICE_COLUMNS].values
+    reservations_df = compact_reservations(reservations_df)
+    
+    # 顧客データ
+    customers = []
+    for i in range(50):
+        age_group = np.random.choice(["20代", "30代", "40代", "50代", "60代以上"], p=[0.1, 0.3, 0.3, 0.2, 0.1])
+        customers.append({
+            "id": i + 1,
+            "name": f"顧客{i+1}",
+            "email": f"customer{i+1}@example.com",
+            "phone": f"090-{np.random.randint(1000, 9999)}-{np.random.randint(1000, 9999)}",
+            "age_group": age_group,
+            "prefecture": np.random.choice(["東京都", "神奈川県", "埼玉県", "千葉県", "その他"], p=[0.3, 0.2, 0.2, 0.2, 0.1]),
+            "first_visit": (datetime.now() - timedelta(days=np.random.randint(0, 365))).strftime("%Y-%m-%d"),
+            "visit_count": np.random.randint(1, 10),
+            "preferences": np.random.choice(["いちご", "りんご", "ぶどう", "みかん", "さくらんぼ"], size=np.random.randint(1, 3)).tolist()
+        })
+    customers_df, customer_preferences = compact_customers(pd.DataFrame(customers))
+    
+    # イベントデータ（収穫時期の初日に収穫祭を開催）
+    events = []
+    for i, farm in farms.iterrows():
+        start_month = int(farm["harvest_season_start"].replace("月", ""))
+        for year in range(datetime.now().year - 1, datetime.now().year + 2):
+            events.append({
+                "farm_id": farm["id"],
+                "date": f"{year}-{start_month:02d}-15",
+                "name": f"{farm['main_crop']}収穫祭"
+            })
+    events_df = pd.DataFrame(events)
+    event_dates = set(events_df["date"])
+    
+    # 来客データ
+    visitor_data = []
+    start_date = datetime.now() - timedelta(days=365)
+    for i in range(365):
+        date = start_date + timedelta(days=i)
+        day_of_week = date.weekday()
+        is_weekend = 1 if day_of_week >= 5 else 0
+        is_holiday = 1 if date.strftime("%m-%d") in JAPANESE_HOLIDAYS else 0
+        has_event = 1 if date.strftime("%Y-%m-%d") in event_dates else 0
+        
+        # 基本来客数
+        base = 30
+        
+        # 曜日の影響（週末は多い）
+        if is_weekend:
+            base += 40
+        
+        # 祝日の影響
+        if is_holiday:
+            base += 30
+        
+        # イベントの影響
+        if has_event:
+            base += 20
+        
+        # 季節の影響
+        month = date.month
+        season_factor = np.sin(month / 12 * 2 * np.pi) * 20 + 20
+        base += season_factor
+        
+        # ランダム変動
+        noise = np.random.normal(0, 10)
+        
+        # 最終来客数（負にならないように）
+        visitors = max(0, int(base + noise))
+        
+        visitor_data.append({
+            "date": date.strftime("%Y-%m-%d"),
+            "day_of_week": day_of_week,
+            "is_weekend": is_weekend,
+            "is_holiday": is_holiday,
+            "month": month,
+            "visitors": visitors
+        })
+    visitor_df = pd.DataFrame(visitor_data)
+    
+    return farms, reservations_df, customers_df, customer_preferences, visitor_df, events_df
+
+# データの読み込み（予約はイベントログから農園ごとのシャードとして読み込む）
+farms, _, customers, customer_preferences, visitor_data, events = generate_mock_data()
+
+SHARD_WORKERS = 4                  # シャードをまたぐ集計を並列に実行するスレッド数
+EVENT_LOG_DIR = "data/events"      # 予約イベントログの保存先
+SNAPSHOT_INTERVAL_EVENTS = 100_000  # スナップショットを作成するまでのイベント数
+
+# 予約ストアの状態（初回のアクセス時に作成）
+_booking_registry = {"store": None, "lock": threading.Lock()}
+
+# 予約ストアの作成（イベントログ・農園ごとのシャード・予約IDの採番・キャンセル待ち）
+# ログが空の場合はモックデータの予約を初期イベントとして書き込む
+def _open_booking_store():
+    log = open_event_log(EVENT_LOG_DIR)
+    if log["next_sequence"] == 0:
+        append_events(log, events_from_reservations(generate_mock_data()[1], "初期データ"))
+    return {
+        "log": log,
+        "compacting": False,
+        "shards": {},
+        "loading": {},
+        "ids": itertools.count(max_reservation_id(log) + 1),
+        "waitlist": pd.DataFrame(columns=[
+            "id", "farm_id", "customer_id", "date", "time_slot",
+            "adults", "children", "seniors", "requested_at", "status", "reservation_id"
+        ]),
+        "lock": threading.Lock(),
+        "executor": ThreadPoolExecutor(max_workers=1),
+        "scatter": ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+    }
+
+# 予約ストア（全セッション・API で共有）
+def _booking_store():
+    if _booking_registry["store"] is None:
+        with _booking_registry["lock"]:
+            if _booking_registry["store"] is None:
+                _booking_registry["store"] = _open_booking_store()
+    return _booking_registry["store"]
+
+# 予約イベントログ
+def get_booking_log():
+    return _booking_store()["log"]
+
+# キャンセル待ちの一覧（繰り上げ中の変更と重ならないよう、ロックを取って複製する）
+def get_waitlist():
+    store = _booking_store()
+    with store["lock"]:
+        return store["waitlist"].copy()
+
+# 農園のシャードの読み込み（イベントログからその農園のイベントだけを再生する）
+# revision は最後に反映したイベントの通し番号で、作り直した後もキャッシュのキーとして使える
+def _load_shard(store, farm_id):
+    log = store["log"]
+    return {
+        "farm_id": farm_id,
+        "region": farms.set_index("id").at[farm_id, "location"],
+        "reservations": state_to_frame(load_state(log, farm_id)),
+        "occupancy": None,
+        "revision": log["next_sequence"],
+        "lock": threading.Lock()
+    }
+
+# 予約ストアの農園のシャード（初回のアクセス時に読み込む、読み込みは農園ごとのロックで他の農園と並行に行う）
+def _store_shard(store, farm_id):
+    shard = store["shards"].get(farm_id)
+    if shard is None:
+        with store["lock"]:
+            loading = store["loading"].setdefault(farm_id, threading.Lock())
+        with loading:
+            shard = store["shards"].get(farm_id)
+            if shard is None:
+                shard = store["shards"][farm_id] = _load_shard(store, farm_id)
+    return shard
+
+# 農園のシャード
+def get_shard(farm_id):
+    return _store_shard(_booking_store(), farm_id)
+
+# イベントログへの記録（スナップショット以降のイベントが一定数を超えたらバックグラウンドでコンパクション）
+def _record_events(events):
+    store = _booking_store()
+    _, end = append_events(store["log"], events)
+    if events_since_snapshot(store["log"]) >= SNAPSHOT_INTERVAL_EVENTS and not store["compacting"]:
+        store["compacting"] = True
+        store["executor"].submit(_compact_booking_log, store)
+    return end
+
+# スナップショットの作成
+def _compact_booking_log(store):
+    try:
+        compact_event_log(store["log"])
+    finally:
+        store["compacting"] = False
+
+# 全シャードをイベントログの再生で作り直す（作り直したイベント数と所要秒数）
+def rebuild_from_event_log():
+    store = _booking_store()
+    started = time.perf_counter()
+    with store["lock"]:
+        store["shards"] = {}
+    _availability_registry["index"] = None
+    scatter_gather(lambda shard: None)
+    return store["log"]["next_sequence"] - store["log"]["snapshot"], time.perf_counter() - started
+
+# 地域（都道府県）に属する農園ID
+def region_farm_ids(region):
+    return farms.loc[farms["location"] == region, "id"].tolist()
+
+# 各シャードで fn を並列に実行し、農園IDごとの結果を返す（省略時は全農園）
+# 予約ストアは呼び出し元のスレッドで取得して渡し、未読み込みのシャードは各スレッドでそのストアに読み込む
+def scatter_gather(fn, farm_ids=None):
+    farm_ids = farms["id"].tolist() if farm_ids is None else list(farm_ids)
+    store = _booking_store()
+    futures = [
+        store["scatter"].submit(lambda farm_id: fn(_store_shard(store, farm_id)), farm_id) for farm_id in farm_ids
+    ]
+    return {farm_id: future.result() for farm_id, future in zip(farm_ids, futures)}
+
+# 指定した農園（省略時は全農園）の予約データ
+def gather_reservations(farm_ids=None):
+    farm_ids = farms["id"].tolist() if farm_ids is None else farm_ids
+    return pd.concat(
+        [get_shard(farm_id)["reservations"] for farm_id in farm_ids], ignore_index=True
+    ).sort_values("id", ignore_index=True)
+
+# 農園ごとの予約件数（指定した農園のみ、省略時は全農園）
+def reservation_counts(farm_ids=None):
+    return pd.Series(scatter_gather(lambda shard: len(shard["reservations"]), farm_ids))
+
+# 顧客の予約履歴（各シャードでその顧客の予約だけを取り出して連結）
+def customer_reservations(customer_id):
+    return pd.concat(scatter_gather(
+        lambda shard: shard["reservations"][shard["reservations"]["customer_id"] == customer_id]
+    ).values(), ignore_index=True).sort_values("id", ignore_index=True)
+
+# 受付枠の設定
+TIME_SLOTS = np.arange(9, 17)      # 受付時間帯（時）
+VISITORS_PER_STAFF = 8             # スタッフ1人が1時間帯に案内できる人数
+STAFF_SHIFT_SLOTS = 6              # スタッフ1人が1日に勤務できる時間帯数
+CAPACITY_BUFFER = 1.2              # 予測来客数に対する受付枠の余裕率
+MIN_SLOT_CAPACITY = 6              # 1時間帯あたりの最低受付人数
+OFF_SEASON_FACTOR = 0.2            # 収穫時期外の来客数の割合
+PLANNING_HORIZON_DAYS = 90         # 受付枠を公開する日数
+OVERBOOKING_RISK = 0.5             # キャンセル率のうち過剰受付に充てる割合
+MAX_OVERBOOKING_RATE = 0.2         # 受付枠に対する過剰受付の上限
+COHORT_CHUNK_ROWS = 50_000         # コホート集計で一度に読み込む予約の行数
+FORECAST_QUANTILES = [0.1, 0.5, 0.9]  # 予測する分位点（P10/P50/P90）
+FORECAST_FEATURES = [
+    "day_of_week", "is_weekend", "is_holiday", "month", "has_event", "is_harvest_season", "farm_share",
+    "weather_rainy", "weather_sunny", "precipitation_prob", "temperature", "recent_visitors"
+]
+WEATHER_PATH = "data/weather.csv"    # 気象データ（date, prefecture, weather, precipitation_prob, temperature）
+HOLIDAYS_PATH = "data/holidays.csv"  # 祝日データ（date, name）
+RECENT_VISITORS_WINDOW = 7         # 直近来客数の集計日数
+OFF_SEASON_PRICE_FACTOR = 0.8      # 収穫時期外の料金倍率
+SLOT_PRICE_FACTORS = np.array([1.1, 1.1, 1.0, 1.0, 1.0, 1.0, 0.9, 0.9])  # 時間帯ごとの料金倍率
+TARGET_OCCUPANCY = 0.7             # 動的料金の基準とする予測稼働率
+PRICE_ELASTICITY = 0.5             # 予測稼働率の基準との差に対する料金の変化率
+DYNAMIC_PRICE_RANGE = (0.8, 1.3)   # 動的料金の倍率の範囲
+AVAILABILITY_TTL_SECONDS = 60      # 受付上限の索引を作り直す間隔（秒）
+
+# 分位点回帰モデルの作成
+def make_quantile_model(quantile):
+    from sklearn.ensemble import HistGradientBoostingRegressor
+    return HistGradientBoostingRegressor(loss="quantile", quantile=quantile, max_iter=200, random_state=42)
+
+# 祝日データ（ファイルがない場合は固定日の祝日）
+@functools.lru_cache(maxsize=None)
+def load_holidays(first_year, last_year):
+    if os.path.exists(HOLIDAYS_PATH):
+        return pd.to_datetime(pd.read_csv(HOLIDAYS_PATH)["date"]).values.astype("datetime64[D]")
+    return np.array(
+        [f"{year}-{day}" for year in range(first_year, last_year + 1) for day in JAPANESE_HOLIDAYS],
+        dtype="datetime64[D]"
+    )
+
+# 気象データ（ファイルがない場合は季節変動に沿ったモックデータ、prefectures はタプル）
+@functools.lru_cache(maxsize=8)
+def load_weather(start_date, end_date, prefectures):
+    dates = pd.date_range(start_date, end_date)
+    if os.path.exists(WEATHER_PATH):
+        weather = pd.read_csv(WEATHER_PATH)
+        weather["date"] = pd.to_datetime(weather["date"])
+    else:
+        rng = np.random.default_rng(42)
+        grid = pd.MultiIndex.from_product([dates, prefectures], names=["date", "prefecture"]).to_frame(index=False)
+        day_of_year = grid["date"].dt.dayofyear.values
+        grid["precipitation_prob"] = np.round(rng.beta(2, 3, len(grid)) * 100)
+        grid["temperature"] = np.round(15 - 10 * np.cos((day_of_year - 20) / 365 * 2 * np.pi) + rng.normal(0, 3, len(grid)), 1)
+        grid["weather"] = np.select(
+            [grid["precipitation_prob"] >= 60, grid["precipitation_prob"] < 30],
+            ["雨", "晴れ"],
+            default="曇り"
+        )
+        weather = grid
+    
+    # 欠損日は都道府県・月ごとの平均で補完
+    weather = pd.MultiIndex.from_product([dates, prefectures], names=["date", "prefecture"]).to_frame(index=False).merge(
+        weather, on=["date", "prefecture"], how="left"
+    )
+    month = weather["date"].dt.month
+    for column in ["precipitation_prob", "temperature"]:
+        weather[column] = weather[column].fillna(weather.groupby(["prefecture", month])[column].transform("mean"))
+        weather[column] = weather[column].fillna(weather[column].mean())
+    weather["weather_rainy"] = (weather["weather"] == "雨").astype(int)
+    weather["weather_sunny"] = (weather["weather"] == "晴れ").astype(int)
+    return weather.drop(columns="weather")
+
+# 農園ごとの来客比率（農園数 × 日数、各日の合計が1）
+def _farm_share(months):
+    # 予約実績の多さと収穫時期で全体の来客数を各農園に按分
+    share = reservation_counts().reindex(farms["id"], fill_value=0).values + 1
+    in_season = _harvest_season_mask(months)
+    weight = share[:, None] * np.where(in_season, 1.0, OFF_SEASON_FACTOR)
+    return weight / weight.sum(axis=0, keepdims=True)
+
+# 農園ごとの収穫時期フラグ（農園数 × 日数）
+def _harvest_season_mask(months):
+    return np.array([
+        np.isin(months, _harvest_months(start, end))
+        for start, end in zip(farms["harvest_season_start"], farms["harvest_season_end"])
+    ])
+
+# 指定期間の特徴量（農園 × 日付の行、先頭 lookback 日は直近来客数の計算にのみ使用）
+# share は農園ごとの来客比率（農園数 × 日数）で、農園を区別する特徴量として使う
+def _compute_features(dates, farm_visitors, share, lookback):
+    n_farms, n_days = farm_visitors.shape
+    
+    # 直近来客数：前日までの移動平均（観測期間の翌日以降は最終観測時点の値で固定）
+    # 先頭 lookback 日は観測期間より前のため欠損でもよい
+    recent = pd.DataFrame(farm_visitors.T).rolling(RECENT_VISITORS_WINDOW, min_periods=1).mean().shift(1).values.T
+    unobserved = np.flatnonzero(np.isnan(farm_visitors[:, lookback:]).any(axis=0))
+    if len(unobserved) > 0:
+        first_unobserved = lookback + unobserved[0]
+        recent[:, first_unobserved:] = recent[:, [first_unobserved]]
+    
+    dates = dates[lookback:]
+    months = dates.month.values
+    day_of_week = dates.dayofweek.values
+    holidays = load_holidays(dates.year.min(), dates.year.max())
+    
+    frame = pd.DataFrame({
+        "farm_id": np.repeat(farms["id"].values, len(dates)),
+        "date": np.tile(dates.values, n_farms),
+        "day_of_week": np.tile(day_of_week, n_farms),
+        "is_weekend": np.tile((day_of_week >= 5).astype(int), n_farms),
+        "is_holiday": np.tile(np.isin(dates.values.astype("datetime64[D]"), holidays).astype(int), n_farms),
+        "month": np.tile(months, n_farms),
+        "is_harvest_season": _harvest_season_mask(months).astype(int).ravel(),
+        "farm_share": share[:, lookback:].ravel(),
+        "recent_visitors": recent[:, lookback:].ravel(),
+        "visitors": farm_visitors[:, lookback:].ravel()
+    })
+    
+    event_keys = pd.MultiIndex.from_arrays([events["farm_id"], pd.to_datetime(events["date"])])
+    frame["has_event"] = pd.MultiIndex.from_arrays([frame["farm_id"], frame["date"]]).isin(event_keys).astype(int)
+    
+    frame["prefecture"] = frame["farm_id"].map(farms.set_index("id")["location"])
+    weather = load_weather(dates.min(), dates.max(), tuple(sorted(farms["location"].unique())))
+    frame = frame.merge(weather, on=["date", "prefecture"], how="left").drop(columns="prefecture")
+    return frame
+
+# 特徴量ストアの状態（更新と、それに続くモデルの学習・予測は lock で直列化）
+_feature_store_registry = {"frame": None, "history_end": None, "end": None, "version": None, "lock": threading.RLock()}
+
+# 特徴量ストア（農園 × 日付）：学習と予測の両方がこの列データを使う
+# 前回の観測終了日までの行は再利用し、それ以降の行だけを計算し直す
+def get_feature_store():
+    registry = _feature_store_registry
+    with registry["lock"]:
+        history_dates = pd.to_datetime(visitor_data["date"])
+        history_start, history_end = history_dates.min(), history_dates.max()
+        end = pd.Timestamp(_forecast_start()) + pd.Timedelta(days=PLANNING_HORIZON_DAYS - 1)
+        
+        frame = registry["frame"]
+        if frame is not None and registry["history_end"] == history_end and registry["end"] >= end:
+            return frame
+        
+        recompute_from = history_start
+        if frame is not None and registry["history_end"] <= history_end:
+            recompute_from = registry["history_end"] + pd.Timedelta(days=1)
+        
+        lookback = RECENT_VISITORS_WINDOW
+        dates = pd.date_range(recompute_from - pd.Timedelta(days=lookback), end)
+        total = visitor_data.set_index(history_dates)["visitors"].reindex(dates).values
+        share = _farm_share(dates.month.values)
+        new_rows = _compute_features(dates, total[None, :] * share, share, lookback)
+        
+        if frame is not None and recompute_from > history_start:
+            new_rows = pd.concat([frame[frame["date"] < recompute_from], new_rows])
+        frame = new_rows.sort_values(["farm_id", "date"], kind="stable").reset_index(drop=True)
+        
+        registry.update({
+            "frame": frame,
+            "history_end": history_end,
+            "end": end,
+            "version": hashlib.sha1(pd.util.hash_pandas_object(frame, index=False).values.tobytes()).hexdigest()[:12]
+        })
+        return frame
+
+# 分位点回帰モデルの学習（P10/P50/P90、最新の特徴量ストアのバージョンのみ保持）
+@functools.lru_cache(maxsize=1)
+def train_quantile_models(store_version):
+    store = get_feature_store()
+    history = store[store["visitors"].notna()]
+    X = history[FORECAST_FEATURES].to_numpy(dtype=float)
+    y = history["visitors"].to_numpy(dtype=float)
+    return [make_quantile_model(q).fit(X, y) for q in FORECAST_QUANTILES]
+
+# 予測の開始日（翌日）
+def _forecast_start():
+    return (pd.Timestamp.now().normalize() + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+
+# 公開期間全体・全農園の予測を一括で計算してキャッシュ（最新の開始日・特徴量ストアのバージョンのみ保持）
+# 戻り値は全体の予測データフレームと農園ごとの分位点（分位点数 × 農園数 × 日数）
+@functools.lru_cache(maxsize=1)
+def _forecast_horizon(start_date, store_version):
+    store = get_feature_store()
+    dates = pd.date_range(start_date, periods=PLANNING_HORIZON_DAYS)
+    horizon = store[store["date"].isin(dates)]
+    X = horizon[FORECAST_FEATURES].to_numpy(dtype=float)
+    
+    # 分位点の交差を防ぐため並べ替え
+    models = train_quantile_models(store_version)
+    quantiles = np.stack([model.predict(X) for model in models])
+    farm_quantiles = np.maximum(0, np.sort(quantiles, axis=0)).reshape(len(models), len(farms), len(dates))
+    
+    # 全体の予測は農園ごとの予測の合計（区間は各農園の分位点の合計で保守的に見積もる）
+    lower, median, upper = farm_quantiles.sum(axis=1)
+    day_of_week = dates.dayofweek.values
+    predictions_df = pd.DataFrame({
+        "date": dates.strftime("%Y-%m-%d"),
+        "day_of_week": day_of_week,
+        "is_weekend": (day_of_week >= 5).astype(int),
+        "month": dates.month.values,
+        "predicted_visitors": np.round(median).astype(int),
+        "lower_visitors": lower,
+        "upper_visitors": upper
+    })
+    return predictions_df, farm_quantiles
+
+# 最新の特徴量ストアに基づく予測（画面と API が同時に呼んでも学習は1回だけ行う）
+def _current_forecast():
+    with _feature_store_registry["lock"]:
+        get_feature_store()
+        return _forecast_horizon(_forecast_start(), _feature_store_registry["version"])
+
+# 来客数の予測（翌日から prediction_days 日分）
+def forecast_visitors(prediction_days):
+    predictions_df, _ = _current_forecast()
+    return predictions_df.head(prediction_days).copy()
+
+# 農園ごとの日別予測来客数と予測区間（それぞれ農園数 × 日数）
+def forecast_farm_visitors(predictions_df):
+    _, farm_quantiles = _current_forecast()
+    lower, median, upper = farm_quantiles[:, :, :len(predictions_df)]
+    return median, lower, upper
+
+# 時間帯ごとの来客比率（予約実績から推定、シャードごとの件数を合計）
+def slot_profile():
+    counts = sum(scatter_gather(
+        lambda shard: shard["reservations"]["time_slot"].value_counts().reindex(TIME_SLOTS, fill_value=0).values
+    ).values()) + 1
+    return counts / counts.sum()
+
+# 時間帯ごとの受付人数を決定（セル数 × 時間帯数）
+# 各時間帯の受付人数を「需要 × 共通倍率」とし、圃場とスタッフの上限を超えない
+# 最大の倍率を全セル同時に二分探索する
+def plan_slot_capacity(daily_demand, slot_profile, staff_count, field_capacity):
+    demand = daily_demand[:, None] * slot_profile[None, :]
+    slot_limit = np.minimum(field_capacity, staff_count * VISITORS_PER_STAFF)[:, None]
+    daily_limit = (staff_count * STAFF_SHIFT_SLOTS * VISITORS_PER_STAFF)[:, None]
+    
+    def allocate(scale):
+        return np.minimum(slot_limit, np.maximum(MIN_SLOT_CAPACITY, scale * demand))
+    
+    def total(scale):
+        return allocate(scale).sum(axis=1, keepdims=True)
+    
+    hi = np.full((len(demand), 1), CAPACITY_BUFFER)
+    lo = np.where(total(hi) <= daily_limit, hi, 0.0)
+    for _ in range(30):
+        mid = (lo + hi) / 2
+        fits = total(mid) <= daily_limit
+        lo = np.where(fits, mid, lo)
+        hi = np.where(fits, hi, mid)
+    
+    return np.floor(allocate(lo)).astype(np.int32)
+
+# 受付枠の公開状態
+_capacity_registry = {"published": None, "lock": threading.Lock()}
+
+# 予測に基づいて受付枠を公開（予測が変化した農園・日付のみ再計算、同時に呼ばれた場合は lock で直列化）
+def publish_slot_capacity(predictions_df):
+    farm_ids = farms["id"].tolist()
+    dates = predictions_df["date"].values
+    farm_forecast, farm_lower, farm_upper = forecast_farm_visitors(predictions_df)
+    
+    capacity = np.zeros(farm_forecast.shape + (len(TIME_SLOTS),), dtype=np.int32)
+    stale = np.ones(farm_forecast.shape, dtype=bool)
+    
+    registry = _capacity_registry
+    with registry["lock"]:
+        previous = registry["published"]
+        if previous is not None and previous["farm_ids"] == farm_ids:
+            _, new_idx, old_idx = np.intersect1d(dates, previous["dates"], return_indices=True)
+            capacity[:, new_idx] = previous["capacity"][:, old_idx]
+            stale[:, new_idx] = ~np.isclose(farm_forecast[:, new_idx], previous["forecast"][:, old_idx])
+        
+        farm_idx, day_idx = np.nonzero(stale)
+        if len(farm_idx) > 0:
+            capacity[farm_idx, day_idx] = plan_slot_capacity(
+                farm_forecast[farm_idx, day_idx],
+                slot_profile(),
+                farms["staff_count"].values[farm_idx],
+                farms["field_capacity"].values[farm_idx]
+            )
+        
+        version = hashlib.sha1(b"".join(a.tobytes() for a in (dates.astype(str), farm_forecast, farm_lower, farm_upper)))
+        registry["published"] = {
+            "farm_ids": farm_ids,
+            "dates": dates,
+            "forecast": farm_forecast,
+            "lower": farm_lower,
+            "upper": farm_upper,
+            "capacity": capacity,
+            "version": version.hexdigest()[:12],
+            "updated": int(stale.sum())
+        }
+        return registry["published"]
+
+# 公開期間分の受付枠を取得
+def get_slot_capacity():
+    return publish_slot_capacity(forecast_visitors(PLANNING_HORIZON_DAYS))
+
+# 農園ごとの過剰受付率（過去のキャンセル率に基づく）
+def _overbooking_margins():
+    cancel_rate = pd.Series(scatter_gather(
+        lambda shard: (shard["reservations"]["status"] == "キャンセル").mean()
+    )).fillna(0.0)
+    margin = np.minimum(MAX_OVERBOOKING_RATE, cancel_rate * OVERBOOKING_RISK)
+    return margin.reindex(farms["id"], fill_value=0.0)
+
+# 受付上限の索引の状態（作り直しは lock で直列化し、定期的な作り直しは executor で実行）
+_availability_registry = {
+    "index": None, "lock": threading.Lock(), "refreshing": False, "executor": ThreadPoolExecutor(max_workers=1)
+}
+
+# 受付上限の索引と料金表を同じ受付枠から作り直す
+def _rebuild_availability_index():
+    published = get_slot_capacity()
+    margins = _overbooking_margins().values
+    index = {
+        "today": datetime.now().date(),
+        "start": np.datetime64(published["dates"][0], "D"),
+        "farm_index": {farm_id: i for i, farm_id in enumerate(published["farm_ids"])},
+        "limits": (published["capacity"] * (1 + margins)[:, None, None]).astype(np.int32),
+        "version": published["version"],
+        "built": time.monotonic()
+    }
+    prices = _price_registry
+    if prices["table"] is None or prices["table"]["version"] != index["version"]:
+        prices["table"] = reprice_season(published)
+    _availability_registry["index"] = index
+    return index
+
+# 一定時間ごとの作り直し（バックグラウンド）
+def _refresh_availability_index():
+    registry = _availability_registry
+    try:
+        with registry["lock"]:
+            _rebuild_availability_index()
+    finally:
+        registry["refreshing"] = False
+
+# 受付上限の索引がそのまま使えるか（未作成の場合と予測の開始日が変わった場合は作り直しが必要）
+def availability_index_ready():
+    index = _availability_registry["index"]
+    return index is not None and index["today"] == datetime.now().date()
+
+# 受付上限の索引（農園数 × 公開日数 × 時間帯数、過剰受付を含む）
+# 使えない場合だけその場で作り直し、一定時間ごとの作り直しはバックグラウンドで行う
+# （作り直しの間は前回の索引を返すため、照会は配列の参照だけで済む）
+def get_availability_index():
+    registry = _availability_registry
+    if not availability_index_ready():
+        with registry["lock"]:
+            if not availability_index_ready():
+                _rebuild_availability_index()
+    
+    index = registry["index"]
+    if time.monotonic() - index["built"] > AVAILABILITY_TTL_SECONDS and not registry["refreshing"]:
+        registry["refreshing"] = True
+        registry["executor"].submit(_refresh_availability_index)
+    return index
+
+# 時間帯の受付上限（過剰受付を含む、受付枠が未公開の場合は None）
+def _slot_limit(farm_id, date, time_slot):
+    index = get_availability_index()
+    day = (np.datetime64(date, "D") - index["start"]).astype(int)
+    if not 0 <= day < index["limits"].shape[1]:
+        return None
+    return int(index["limits"][index["farm_index"][farm_id], day, int(time_slot) - TIME_SLOTS[0]])
+
+# 農園の占有状況の配列（日付 × 時間帯 × 人数区分）を予約から構築
+def _build_occupancy(reservations_df):
+    today = np.datetime64(datetime.now().date())
+    dates = reservations_df["date"].values.astype("datetime64[D]")
+    start = min(dates.min(), today) if len(dates) > 0 else today
+    end = max(dates.max(), today + PLANNING_HORIZON_DAYS) if len(dates) > 0 else today + PLANNING_HORIZON_DAYS
+    counts = np.zeros(((end - start).astype(int) + 1, len(TIME_SLOTS), len(PARTY_COLUMNS)), dtype=np.int32)
+    
+    active = (reservations_df["status"] != "キャンセル").values
+    slot_index = reservations_df["time_slot"].values.astype(int) - TIME_SLOTS[0]
+    np.add.at(
+        counts,
+        ((dates[active] - start).astype(int), slot_index[active]),
+        reservations_df[PARTY_COLUMNS].values[active]
+    )
+    return {"start": start, "counts": counts}
+
+# シャードの占有状況（初回のみ構築し、以降は予約の変更ごとに差分を反映）
+def get_occupancy(shard):
+    if shard["occupancy"] is None:
+        shard["occupancy"] = _build_occupancy(shard["reservations"])
+    return shard["occupancy"]
+
+# 占有状況の配列上の位置（範囲外の場合は None）
+def _occupancy_index(occupancy, date, time_slot):
+    day = (np.datetime64(date, "D") - occupancy["start"]).astype(int)
+    if not 0 <= day < occupancy["counts"].shape[0]:
+        return None
+    return day, int(time_slot) - TIME_SLOTS[0]
+
+# 予約の追加・キャンセルを占有状況に反映（範囲外の日付の場合は作り直す）
+def _update_occupancy(shard, date, time_slot, party_counts, sign):
+    occupancy = get_occupancy(shard)
+    index = _occupancy_index(occupancy, date, time_slot)
+    if index is None:
+        shard["occupancy"] = _build_occupancy(shard["reservations"])
+    else:
+        occupancy["counts"][index] += sign * np.asarray(party_counts, dtype=np.int32)
+
+# 指定した月の占有状況（日数 × 時間帯 × 人数区分）
+def occupancy_for_month(occupancy, month):
+    first = (np.datetime64(month.start_time.date(), "D") - occupancy["start"]).astype(int)
+    days = month.days_in_month
+    month_counts = np.zeros((days, len(TIME_SLOTS), len(PARTY_COLUMNS)), dtype=np.int32)
+    
+    lo, hi = max(first, 0), min(first + days, occupancy["counts"].shape[0])
+    if lo < hi:
+        month_counts[lo - first:hi - first] = occupancy["counts"][lo:hi]
+    return month_counts
+
+# 時間帯の予約済み人数（キャンセルを除く）
+def _booked_people(shard, date, time_slot):
+    occupancy = get_occupancy(shard)
+    index = _occupancy_index(occupancy, date, time_slot)
+    return 0 if index is None else int(occupancy["counts"][index].sum())
+
+# 時間帯ごとの残り受付人数（時間帯数、受付枠が未公開の場合は None）
+def slot_availability(farm_id, date):
+    index = get_availability_index()
+    day = (np.datetime64(pd.Timestamp(date).normalize(), "D") - index["start"]).astype(int)
+    if not 0 <= day < index["limits"].shape[1]:
+        return None
+    
+    limits = index["limits"][index["farm_index"][farm_id], day]
+    occupancy = get_occupancy(get_shard(farm_id))
+    occupancy_day = (index["start"] - occupancy["start"]).astype(int) + day
+    if occupancy_day >= occupancy["counts"].shape[0]:
+        # 占有状況の範囲外の日付には予約がない（予約の追加時に範囲を広げて作り直すため）
+        return limits.copy()
+    return np.maximum(0, limits - occupancy["counts"][occupancy_day].sum(axis=1))
+
+# 残り受付人数（受付枠が未公開の場合は None）
+def remaining_capacity(farm_id, date, time_slot):
+    remaining = slot_availability(farm_id, date)
+    if remaining is None:
+        return None
+    return int(remaining[int(time_slot) - TIME_SLOTS[0]])
+
+# シャードの予約データへの行の追加（コンパクトな型を保つため変換してから連結）
+# unit_prices は予約時に確定した1人あたり料金（大人・子供・シニア）
+def _append_reservation(shard, customer_id, date, time_slot, party, unit_prices, source):
+    reservation_id = next(_booking_store()["ids"])
+    row = compact_reservations(pd.DataFrame([{
+        "id": reservation_id,
+        "farm_id": shard["farm_id"],
+        "customer_id": customer_id,
+        "date": date,
+        "time_slot": time_slot,
+        **party,
+        **dict(zip(PRICE_COLUMNS, unit_prices)),
+        "status": "確定",
+        "created_at": pd.Timestamp.now().normalize()
+    }]))
+    shard["revision"] = _record_events(make_events(
+        EVENT_CREATED, source, row["id"].values, row["farm_id"].values, row["customer_id"].values,
+        row["date"].values, row["time_slot"].values, {column: row[column].values for column in PARTY_COLUMNS},
+        {column: row[column].values for column in PRICE_COLUMNS}, row["status"].cat.codes.values
+    ))
+    shard["reservations"] = pd.concat([shard["reservations"], row], ignore_index=True)
+    _update_occupancy(shard, date, time_slot, [party[column] for column in PARTY_COLUMNS], 1)
+    return reservation_id
+
+# 予約の登録（受付枠が未公開の日付、または受付上限を超える場合は None）
+# unit_prices は提示した1人あたり料金で、省略時は現在の料金表から決める
+def create_reservation(farm_id, customer_id, date, time_slot, party, unit_prices=None, source="画面"):
+    shard = get_shard(farm_id)
+    date = pd.Timestamp(date).normalize()
+    limit = _slot_limit(farm_id, date, time_slot)
+    if limit is None:
+        return None
+    if unit_prices is None:
+        unit_prices = quote_prices(farm_id, date, time_slot)
+    
+    with shard["lock"]:
+        booked = _booked_people(shard, date, time_slot)
+        if booked + sum(party.values()) > limit:
+            return None
+        return _append_reservation(shard, customer_id, date, time_slot, party, unit_prices, source)
+
+# キャンセル待ちへの登録
+def add_to_waitlist(farm_id, customer_id, date, time_slot, party):
+    store = _booking_store()
+    with store["lock"]:
+        waitlist = store["waitlist"]
+        waitlist.loc[len(waitlist)] = {
+            "id": len(waitlist) + 1,
+            "farm_id": farm_id,
+            "customer_id": customer_id,
+            "date": pd.Timestamp(date).normalize(),
+            "time_slot": time_slot,
+            **party,
+            "requested_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "status": "待機中",
+            "reservation_id": None
+        }
+
+# 予約のキャンセル（キャンセル待ちの繰り上げはバックグラウンドで実行）
+# 農園を指定した場合はそのシャードだけを、省略時は全シャードを並列に探す
+def cancel_reservation(reservation_id, farm_id=None, source="画面"):
+    found = scatter_gather(
+        lambda shard: bool((shard["reservations"]["id"] == reservation_id).any()),
+        None if farm_id is None else [farm_id]
+    )
+    owners = [owner for owner, has_reservation in found.items() if has_reservation]
+    if not owners:
+        return False
+    
+    shard = get_shard(owners[0])
+    with shard["lock"]:
+        reservations_df = shard["reservations"]
+        target = (reservations_df["id"] == reservation_id) & (reservations_df["status"] != "キャンセル")
+        if not target.any():
+            return False
+        cancelled = reservations_df[target].iloc[0]
+        shard["revision"] = _record_events(make_events(
+            EVENT_STATUS, source, [reservation_id], [shard["farm_id"]], [cancelled["customer_id"]],
+            [cancelled["date"]], [cancelled["time_slot"]], {column: [cancelled[column]] for column in PARTY_COLUMNS},
+            {column: [cancelled[column]] for column in PRICE_COLUMNS}, [RESERVATION_STATUSES.index("キャンセル")]
+        ))
+        reservations_df.loc[target, "status"] = "キャンセル"
+        _update_occupancy(
+            shard, cancelled["date"], cancelled["time_slot"], cancelled[PARTY_COLUMNS].astype(int).tolist(), -1
+        )
+    
+    # 繰り上げる組の料金はキャンセル時点の料金表から呼び出し元のスレッドで決めておく
+    limit = _slot_limit(shard["farm_id"], cancelled["date"], cancelled["time_slot"])
+    if limit is not None:
+        unit_prices = quote_prices(shard["farm_id"], cancelled["date"], cancelled["time_slot"])
+        store = _booking_store()
+        store["executor"].submit(
+            _promote_waitlist, store, shard, cancelled["date"], cancelled["time_slot"], limit, unit_prices
+        ).add_done_callback(_log_promotion_error)
+    return True
+
+# キャンセル待ちの繰り上げで発生した例外をログに出力（バックグラウンドのため画面には表示されない）
+def _log_promotion_error(future):
+    error = future.exception()
+    if error is not None:
+        logging.getLogger(__name__).error("キャンセル待ちの繰り上げに失敗しました", exc_info=error)
+
+# 空いた受付枠へキャンセル待ちを繰り上げ（unit_prices はキャンセル時点の1人あたり料金）
+# 登録順に、空き人数に収まる組を詰めていくファーストフィット法
+def _promote_waitlist(store, shard, date, time_slot, limit, unit_prices):
+    with store["lock"], shard["lock"]:
+        waitlist = store["waitlist"]
+        free = limit - _booked_people(shard, date, time_slot)
+        
+        waiting = waitlist[
+            (waitlist["farm_id"] == shard["farm_id"]) &
+            (waitlist["date"] == date) &
+            (waitlist["time_slot"] == time_slot) &
+            (waitlist["status"] == "待機中")
+        ].sort_values("requested_at")
+        
+        for index, entry in waiting.iterrows():
+            party = {column: int(entry[column]) for column in PARTY_COLUMNS}
+            if sum(party.values()) > free:
+                continue
+            reservation_id = _append_reservation(
+                shard, entry["customer_id"], date, time_slot, party, unit_prices, "キャンセル待ち"
+            )
+            waitlist.loc[index, ["status", "reservation_id"]] = ["繰り上げ済み", reservation_id]
+            free -= sum(party.values())
+
+# 農園ごと・月ごとの季節料金倍率（農園数 × 12）
+def _season_price_factors():
+    return np.where(_harvest_season_mask(np.arange(1, 13)), 1.0, OFF_SEASON_PRICE_FACTOR)
+
+# 基本料金 × 季節 × 時間帯の1人あたり料金（行数 × 人数区分、10円単位）
+def _static_prices(farm_index, dates, slot_index):
+    months = dates.astype("datetime64[M]").astype(int) % 12
+    factor = _season_price_factors()[farm_index, months] * SLOT_PRICE_FACTORS[slot_index]
+    return np.round(farms[PRICE_COLUMNS].values[farm_index] * factor[:, None], -1)
+
+# 予測稼働率に応じた動的料金の倍率（農園数 × 日数 × 時間帯数）
+def _dynamic_price_factors(published):
+    demand = published["forecast"][:, :, None] * slot_profile()[None, None, :]
+    occupancy = demand / np.maximum(published["capacity"], 1)
+    return np.clip(1 + PRICE_ELASTICITY * (occupancy - TARGET_OCCUPANCY), *DYNAMIC_PRICE_RANGE)
+
+# 料金表の状態
+_price_registry = {"table": None}
+
+# 公開期間全体・全農園の料金表を一括で計算（農園数 × 日数 × 時間帯数 × 人数区分）
+def reprice_season(published):
+    n_farms, n_days = published["forecast"].shape
+    start = np.datetime64(published["dates"][0], "D")
+    farm_index, day_index, slot_index = np.indices((n_farms, n_days, len(TIME_SLOTS))).reshape(3, -1)
+    static = _static_prices(farm_index, start + day_index, slot_index)
+    prices = static.reshape(n_farms, n_days, len(TIME_SLOTS), -1) * _dynamic_price_factors(published)[..., None]
+    return {
+        "start": start,
+        "farm_index": {farm_id: i for i, farm_id in enumerate(published["farm_ids"])},
+        "prices": np.round(prices, -1).astype(np.int32),
+        "version": published["version"]
+    }
+
+# 受付上限の索引と同じ受付枠に基づく料金表（通常は索引の作り直し時に再計算済み、refresh 指定時はその場で再計算）
+def get_price_table(refresh=False):
+    registry = _price_registry
+    version = get_availability_index()["version"]
+    if refresh or registry["table"] is None or registry["table"]["version"] != version:
+        registry["table"] = reprice_season(get_slot_capacity())
+    return registry["table"]
+
+# 予約ごとの売上（予約時に確定した料金 × 人数、キャンセルは0）
+def reservation_revenue(reservations_df):
+    revenue = (
+        reservations_df[PARTY_COLUMNS].values.astype(np.int64) * reservations_df[PRICE_COLUMNS].values
+    ).sum(axis=1)
+    return np.where(reservations_df["status"] == "キャンセル", 0, revenue)
+
+# 指定した農園・日付の時間帯ごとの1人あたり料金（時間帯数 × 人数区分）
+def slot_prices(farm_id, date):
+    table = get_price_table()
+    farm_idx = table["farm_index"][farm_id]
+    date = np.datetime64(pd.Timestamp(date).normalize(), "D")
+    day = (date - table["start"]).astype(int)
+    if 0 <= day < table["prices"].shape[1]:
+        return table["prices"][farm_idx, day]
+    
+    slot_index = np.arange(len(TIME_SLOTS))
+    return _static_prices(np.full(len(TIME_SLOTS), farm_idx), np.full(len(TIME_SLOTS), date), slot_index).astype(int)
+
+# 指定した農園・日付・時間帯の1人あたり料金（大人・子供・シニア）
+def quote_prices(farm_id, date, time_slot):
+    return slot_prices(farm_id, date)[int(time_slot) - TIME_SLOTS[0]]
+
+# シャードの予約ごとの売上
+def shard_revenue(shard):
+    shard_reservations = shard["reservations"]
+    return pd.DataFrame({
+        "farm_id": shard_reservations["farm_id"].values,
+        "customer_id": shard_reservations["customer_id"].values,
+        "date": shard_reservations["date"].values,
+        "revenue": reservation_revenue(shard_reservations)
+    })
+
+# 予約データを一定行数ずつ読み込む
+def _iter_reservation_chunks(reservations_df, columns, chunk_rows=COHORT_CHUNK_ROWS):
+    for start in range(0, len(reservations_df), chunk_rows):
+        yield reservations_df.iloc[start:start + chunk_rows][columns]
+
+# コホート集計の状態（更新は lock で直列化）
+_cohort_registry = {"state": None, "lock": threading.Lock()}
+
+# コホート集計の初期状態（顧客ごとの初回・最終訪問日、訪問回数、月別の訪問有無）
+def _empty_cohort_state():
+    first_visit = customers["first_visit"].values.astype("datetime64[D]")
+    start_month = pd.Period(first_visit.min(), freq="M")
+    active = np.zeros((len(customers), 0), dtype=bool)
+    return {
+        "customer_ids": customers["id"].values,
+        "start_month": start_month,
+        "first_seen": first_visit.copy(),
+        "last_seen": first_visit.copy(),
+        "visits": np.ones(len(customers), dtype=np.int32),
+        "active": active,
+        "processed_until": start_month - 1,
+        "version": None
+    }
+
+# シャードの予約のうち lower より後・upper 以前の月の訪問を顧客ごとに集計（一定行数ずつ読み込む）
+# 戻り値は顧客ごとの初回・最終訪問日、訪問回数と、start_month からの月別の訪問有無
+def _shard_cohort_visits(shard, customer_ids, start_month, lower, upper):
+    first_seen = np.full(len(customer_ids), np.datetime64("9999-12-31", "D"))
+    last_seen = np.full(len(customer_ids), np.datetime64("1970-01-01", "D"))
+    visits = np.zeros(len(customer_ids), dtype=np.int32)
+    active = np.zeros((len(customer_ids), upper - start_month + 1), dtype=bool)
+    
+    for chunk in _iter_reservation_chunks(shard["reservations"], ["customer_id", "date", "status"]):
+        dates = chunk["date"].values.astype("datetime64[D]")
+        month_ordinal = dates.astype("datetime64[M]").astype(int)
+        visited = (chunk["status"] != "キャンセル").values & (month_ordinal > lower) & (month_ordinal <= upper)
+        # 顧客データにない顧客IDの予約は集計しない
+        chunk_customer_ids = chunk["customer_id"].values
+        customer_index = np.minimum(np.searchsorted(customer_ids, chunk_customer_ids), len(customer_ids) - 1)
+        visited &= customer_ids[customer_index] == chunk_customer_ids
+        customer_index = customer_index[visited]
+        dates = dates[visited]
+        
+        np.minimum.at(first_seen, customer_index, dates)
+        np.maximum.at(last_seen, customer_index, dates)
+        np.add.at(visits, customer_index, 1)
+        active[customer_index, month_ordinal[visited] - start_month] = True
+    return first_seen, last_seen, visits, active
+
+# 完了した月の予約をコホート集計に反映（未集計の月のみ）
+# シャードごとの集計を並列に行い、結果を順に合算する
+# 複数のセッションが同時に月をまたいでも同じ月を二重に集計しないよう、更新中はロックする
+def update_cohort_state():
+    registry = _cohort_registry
+    with registry["lock"]:
+        state = registry["state"] or _empty_cohort_state()
+        last_complete = pd.Period(datetime.now(), freq="M") - 1
+        if state["processed_until"] >= last_complete:
+            registry["state"] = state
+            return state
+        
+        # 月別の訪問有無の配列を集計対象の月まで広げる
+        n_months = (last_complete - state["start_month"]).n + 1
+        state["active"] = np.pad(state["active"], ((0, 0), (0, n_months - state["active"].shape[1])))
+        
+        shard_visits = scatter_gather(lambda shard: _shard_cohort_visits(
+            shard, state["customer_ids"], state["start_month"].ordinal,
+            state["processed_until"].ordinal, last_complete.ordinal
+        ))
+        for first_seen, last_seen, visits, active in shard_visits.values():
+            np.minimum(state["first_seen"], first_seen, out=state["first_seen"])
+            np.maximum(state["last_seen"], last_seen, out=state["last_seen"])
+            state["visits"] += visits
+            state["active"] |= active
+        
+        state["processed_until"] = last_complete
+        state["version"] = str(last_complete)
+        registry["state"] = state
+        return state
+
+# 収穫月の一覧（年をまたぐ場合にも対応）
+def _harvest_months(start_month, end_month):
+    start = int(start_month.replace("月", ""))
+    end = int(end_month.replace("月", ""))
+    if start <= end:
+        return list(range(start, end + 1))
+    return list(range(start, 13)) + list(range(1, end + 1))
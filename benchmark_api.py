@@ -0,0 +1,86 @@
+# 予約 API の負荷試験（キープアライブ接続を並列に張り、空き状況の照会と予約を繰り返す）
+#
+# 使い方:
+#   uvicorn --factory api:create_standalone_app --port 8000
+#   python benchmark_api.py --url http://127.0.0.1:8000 --connections 64 --seconds 10
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+# 1件のリクエストを送り、ステータスコードを返す（接続は使い回す）
+async def request(reader, writer, host, method, path, body=None):
+    payload = b"" if body is None else json.dumps(body).encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+    )
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+# 1接続分のクライアント（終了時刻まで照会と予約を繰り返す）
+async def client(url, deadline, book_ratio, rng, latencies, statuses):
+    reader, writer = await asyncio.open_connection(url.hostname, url.port)
+    today = np.datetime64("today", "D")
+    while time.perf_counter() < deadline:
+        farm_id = int(rng.integers(1, 6))
+        date = str(today + int(rng.integers(1, 60)))
+        started = time.perf_counter()
+        if rng.random() < book_ratio:
+            status = await request(reader, writer, url.netloc, "POST", "/reservations", {
+                "farm_id": farm_id,
+                "customer_id": int(rng.integers(1, 51)),
+                "date": date,
+                "time_slot": int(rng.integers(9, 17)),
+                "adults": int(rng.integers(1, 4))
+            })
+        else:
+            status = await request(reader, writer, url.netloc, "GET", f"/farms/{farm_id}/availability?date={date}")
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    deadline = time.perf_counter() + args.seconds
+    latencies, statuses = [], {}
+    await asyncio.gather(*(
+        client(url, deadline, args.book_ratio, np.random.default_rng(seed), latencies, statuses)
+        for seed in range(args.connections)
+    ))
+    return np.array(latencies), statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="予約 API の負荷試験を行います")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="API の URL")
+    parser.add_argument("--connections", type=int, default=64, help="同時接続数")
+    parser.add_argument("--seconds", type=float, default=10.0, help="計測時間（秒）")
+    parser.add_argument("--book-ratio", type=float, default=0.05, help="予約リクエストの割合")
+    args = parser.parse_args()
+
+    latencies, statuses = asyncio.run(run(args))
+    print(f"{len(latencies):,}件 / {args.seconds:.0f}秒 = {len(latencies) / args.seconds:,.0f} req/s")
+    print(
+        f"レイテンシ: P50 {np.percentile(latencies, 50) * 1000:.1f} ms, "
+        f"P99 {np.percentile(latencies, 99) * 1000:.1f} ms"
+    )
+    print("ステータス:", dict(sorted(statuses.items())))
+
+
+if __name__ == "__main__":
+    main()
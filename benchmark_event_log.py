@@ -0,0 +1,99 @@
+# 予約イベントログの再生速度とスナップショットの効果の計測
+#
+# 使い方: python benchmark_event_log.py --events 10000000
+#
+# 一時ディレクトリにイベントログを書き込み、
+# 1. 空のストアへの全イベントの再生
+# 2. スナップショットの作成（作成中に1件ずつ追記し、追記の最大待ち時間も計測）
+# 3. スナップショット後に追記したイベントだけの再生（起動時の再生）
+# の所要時間を表示する。
+import argparse
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from event_log import (
+    EVENT_CREATED, EVENT_STATUS, append_events, compact_event_log, load_state, make_events, open_event_log
+)
+from schema import PARTY_COLUMNS, PRICE_COLUMNS, RESERVATION_STATUSES
+
+
+# 登録イベントと状態変更イベント（約2割の予約がキャンセル・利用済みになる）
+def synthetic_events(first_id, count, rng):
+    ids = np.arange(first_id, first_id + count)
+    dates = np.datetime64("2025-01-01") + rng.integers(0, 730, count)
+    party = {column: rng.integers(0, 4, count) for column in PARTY_COLUMNS}
+    prices = {column: rng.integers(70, 400, count) * 10 for column in PRICE_COLUMNS}
+    created = make_events(
+        EVENT_CREATED, "画面", ids, rng.integers(1, 6, count), rng.integers(1, 1_000_001, count),
+        dates, rng.integers(9, 17, count), party, prices, RESERVATION_STATUSES.index("確定")
+    )
+    changed = rng.random(count) < 0.2
+    updates = make_events(
+        EVENT_STATUS, "画面", ids[changed], created["farm_id"][changed], created["customer_id"][changed],
+        dates[changed], created["time_slot"][changed], {column: values[changed] for column, values in party.items()},
+        {column: values[changed] for column, values in prices.items()},
+        rng.integers(1, len(RESERVATION_STATUSES), changed.sum())
+    )
+    return np.concatenate([created, updates])
+
+
+# 約 total 件のイベントを一定件数ずつ追記（書き込んだイベント数と予約数）
+def write_events(log, total, chunk_reservations, first_id, rng):
+    reservations = int(total / 1.2)
+    written = 0
+    for start in range(0, reservations, chunk_reservations):
+        events = synthetic_events(first_id + start, min(chunk_reservations, reservations - start), rng)
+        first, end = append_events(log, events)
+        written += end - first
+    return written, reservations
+
+
+# 再生の所要時間（秒）と再生後の予約数
+def timed_replay(log):
+    start = time.perf_counter()
+    state = load_state(log)
+    return time.perf_counter() - start, len(state)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="予約イベントログの再生速度を計測します")
+    parser.add_argument("--events", type=int, default=10_000_000, help="書き込むイベント数")
+    parser.add_argument("--tail-events", type=int, default=100_000, help="スナップショット後に追記するイベント数")
+    parser.add_argument("--chunk-reservations", type=int, default=1_000_000, help="一度に書き込む予約数")
+    args = parser.parse_args()
+    rng = np.random.default_rng(42)
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = open_event_log(directory)
+        start = time.perf_counter()
+        written, reservations = write_events(log, args.events, args.chunk_reservations, 1, rng)
+        print(f"書き込み: {written:,}件 {time.perf_counter() - start:.2f}秒")
+
+        seconds, replayed = timed_replay(open_event_log(directory))
+        print(f"全イベントの再生: {written:,}件 → 予約 {replayed:,}件 {seconds:.2f}秒 ({written / seconds:,.0f}件/秒)")
+
+        compaction = threading.Thread(target=compact_event_log, args=(log,))
+        start = time.perf_counter()
+        compaction.start()
+        waits, next_id = [], reservations + args.tail_events + 1
+        while compaction.is_alive():
+            appended = time.perf_counter()
+            append_events(log, synthetic_events(next_id, 1, rng))
+            waits.append(time.perf_counter() - appended)
+            next_id += 1
+        compaction.join()
+        print(
+            f"スナップショットの作成: {time.perf_counter() - start:.2f}秒"
+            f"（作成中の追記 {len(waits):,}件、最大待ち時間 {max(waits, default=0) * 1000:.1f} ms）"
+        )
+
+        write_events(log, args.tail_events, args.chunk_reservations, reservations + 1, rng)
+        seconds, replayed = timed_replay(open_event_log(directory))
+        print(f"スナップショット + {args.tail_events:,}件の再生: 予約 {replayed:,}件 {seconds:.2f}秒")
+
+
+if __name__ == "__main__":
+    main()
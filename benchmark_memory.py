@@ -0,0 +1,111 @@
+# 予約・顧客データのメモリ使用量の比較（従来の表現とコンパクトな表現）
+#
+# 使い方: python benchmark_memory.py --rows 10000000
+#
+# 従来の表現のデータは chunk_rows 行ずつ生成・計測して破棄するため、
+# 全行を一度に保持できない環境でも 1000万行の計測ができる。
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from schema import AGE_GROUPS, CROPS, RESERVATION_STATUSES, compact_customers, compact_reservations
+
+PREFECTURES = ["東京都", "神奈川県", "埼玉県", "千葉県", "その他"]
+
+
+# 従来の表現の予約データ（backend.py のモックデータと同じ文字列中心の列）
+def legacy_reservations(rows, start_id, rng):
+    dates = np.datetime64("2025-01-01") + rng.integers(0, 730, rows)
+    return pd.DataFrame({
+        "id": np.arange(start_id, start_id + rows),
+        "farm_id": rng.integers(1, 6, rows),
+        "customer_id": rng.integers(1, 1_000_001, rows),
+        "date": dates.astype(str).astype(object),
+        "time_slot": np.char.add(rng.integers(9, 16, rows).astype(str), ":00").astype(object),
+        "adults": rng.integers(1, 5, rows),
+        "children": rng.integers(0, 4, rows),
+        "seniors": rng.integers(0, 3, rows),
+        "adult_price": rng.integers(120, 300, rows) * 10,
+        "child_price": rng.integers(70, 180, rows) * 10,
+        "senior_price": rng.integers(100, 270, rows) * 10,
+        "status": rng.choice(RESERVATION_STATUSES, rows, p=[0.7, 0.1, 0.2]).astype(object),
+        "created_at": (dates - rng.integers(1, 14, rows)).astype(str).astype(object)
+    })
+
+
+# 従来の表現の顧客データ（好みの作物は Python のリスト）
+def legacy_customers(rows, start_id, rng):
+    ids = np.arange(start_id, start_id + rows)
+    crops = np.array(CROPS, dtype=object)
+    n_preferences = rng.integers(1, 3, rows)
+    preference_codes = rng.integers(0, len(CROPS), (rows, 2))
+    return pd.DataFrame({
+        "id": ids,
+        "name": np.char.add("顧客", ids.astype(str)).astype(object),
+        "email": np.char.add(np.char.add("customer", ids.astype(str)), "@example.com").astype(object),
+        "phone": np.char.add("090-", rng.integers(10_000_000, 99_999_999, rows).astype(str)).astype(object),
+        "age_group": rng.choice(AGE_GROUPS, rows).astype(object),
+        "prefecture": rng.choice(PREFECTURES, rows).astype(object),
+        "first_visit": (np.datetime64("2025-01-01") + rng.integers(0, 365, rows)).astype(str).astype(object),
+        "visit_count": rng.integers(1, 10, rows),
+        "preferences": [list(crops[codes[:n]]) for codes, n in zip(preference_codes, n_preferences)]
+    })
+
+
+# コンパクトな表現の顧客データのメモリ使用量（CSR 配列を含む）
+def _compact_customer_bytes(legacy):
+    customers, preferences = compact_customers(legacy)
+    return customers.memory_usage(deep=True).sum() + preferences["offsets"].nbytes + preferences["codes"].nbytes
+
+
+# 従来の表現とコンパクトな表現のメモリ使用量（バイト）
+def measure(build, compact_bytes, rows, chunk_rows, rng):
+    legacy_bytes = 0
+    compact_total = 0
+    for start in range(0, rows, chunk_rows):
+        legacy = build(min(chunk_rows, rows - start), start + 1, rng)
+        legacy_bytes += legacy.memory_usage(deep=True).sum()
+        compact_total += compact_bytes(legacy)
+        del legacy
+    return legacy_bytes, compact_total
+
+
+# 状態と期間による絞り込みの所要時間（秒）
+def filter_timing(legacy, compact):
+    start = time.perf_counter()
+    legacy[(legacy["status"] == "確定") & (legacy["date"] >= "2025-06-01") & (legacy["date"] <= "2025-08-31")]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compact[(compact["status"] == "確定") & (compact["date"] >= "2025-06-01") & (compact["date"] <= "2025-08-31")]
+    return legacy_seconds, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="予約・顧客データのメモリ使用量を比較します")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="計測する行数")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000, help="一度に生成する行数")
+    args = parser.parse_args()
+    rng = np.random.default_rng(42)
+
+    print(f"{args.rows:,}行")
+    for label, build, compact_bytes in [
+        ("予約", legacy_reservations, lambda df: compact_reservations(df).memory_usage(deep=True).sum()),
+        ("顧客", legacy_customers, _compact_customer_bytes)
+    ]:
+        legacy_bytes, compact_total = measure(build, compact_bytes, args.rows, args.chunk_rows, rng)
+        print(
+            f"{label}: 従来 {legacy_bytes / 2**20:,.0f} MiB ({legacy_bytes / args.rows:.0f} B/行) → "
+            f"コンパクト {compact_total / 2**20:,.0f} MiB ({compact_total / args.rows:.0f} B/行), "
+            f"{legacy_bytes / compact_total:.1f}倍の削減"
+        )
+
+    sample = legacy_reservations(min(args.rows, args.chunk_rows), 1, rng)
+    legacy_seconds, compact_seconds = filter_timing(sample, compact_reservations(sample))
+    print(f"予約の絞り込み（{len(sample):,}行）: 従来 {legacy_seconds * 1000:.1f} ms → コンパクト {compact_seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+# 予約イベントの追記専用ログ
+#
+# - イベントは固定長のレコード（EVENT_DTYPE）としてセグメントファイルに追記する
+# - 読み込みは np.memmap で行い、再生（replay）は numpy の一括処理で現在の状態を組み立てる
+# - スナップショットは、ある通し番号までのイベントを再生した状態（STATE_DTYPE）の .npy ファイル
+#   スナップショット作成時に新しいセグメントへ切り替え、起動時の再生はスナップショット以降のみ行う
+#   （古いセグメントは操作履歴として残す）
+#
+# ファイル構成（通し番号は12桁のゼロ埋め）:
+#   events-<開始番号>.log     開始番号以降のイベント
+#   snapshot-<番号>.npy       番号より前のイベントを再生した状態
+import glob
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from schema import PARTY_COLUMNS, PRICE_COLUMNS, RESERVATION_STATUSES
+
+EVENT_CREATED = 1                  # 予約の登録
+EVENT_STATUS = 2                   # 状態の変更（キャンセル・利用済みなど）
+EVENT_KINDS = {EVENT_CREATED: "登録", EVENT_STATUS: "状態変更"}
+EVENT_SOURCES = ["初期データ", "画面", "API", "キャンセル待ち"]
+
+EVENT_DTYPE = np.dtype([
+    ("timestamp", "<i8"),          # 発生時刻（1970-01-01 からの秒数、ローカル時刻）
+    ("reservation_id", "<i4"),
+    ("customer_id", "<i4"),
+    ("date", "<i4"),               # 予約日（1970-01-01 からの日数）
+    ("adult_price", "<i4"),        # 予約時の1人あたり料金（円）
+    ("child_price", "<i4"),
+    ("senior_price", "<i4"),
+    ("farm_id", "<i2"),
+    ("kind", "u1"),
+    ("status", "u1"),              # RESERVATION_STATUSES の位置
+    ("time_slot", "u1"),
+    ("adults", "u1"),
+    ("children", "u1"),
+    ("seniors", "u1"),
+    ("source", "u1")               # EVENT_SOURCES の位置
+])
+
+STATE_DTYPE = np.dtype([
+    ("id", "<i4"),
+    ("farm_id", "<i2"),
+    ("customer_id", "<i4"),
+    ("date", "<i4"),
+    ("adult_price", "<i4"),
+    ("child_price", "<i4"),
+    ("senior_price", "<i4"),
+    ("time_slot", "u1"),
+    ("adults", "u1"),
+    ("children", "u1"),
+    ("seniors", "u1"),
+    ("status", "u1"),
+    ("created_at", "<i8")
+])
+
+
+# ファイル名の通し番号
+def _sequence(path):
+    return int(os.path.basename(path).split("-")[1].split(".")[0])
+
+
+# セグメント・スナップショットのファイル名
+def _segment_path(directory, sequence):
+    return os.path.join(directory, f"events-{sequence:012d}.log")
+
+
+def _snapshot_path(directory, sequence):
+    return os.path.join(directory, f"snapshot-{sequence:012d}.npy")
+
+
+# イベントログを開く（ディレクトリがない場合は作成）
+def open_event_log(directory):
+    os.makedirs(directory, exist_ok=True)
+    snapshots = sorted(glob.glob(os.path.join(directory, "snapshot-*.npy")), key=_sequence)
+    segments = sorted(glob.glob(os.path.join(directory, "events-*.log")), key=_sequence)
+    if not segments:
+        segments = [_segment_path(directory, 0)]
+        open(segments[0], "ab").close()
+
+    # 書き込み途中で止まった末尾の不完全なレコードを切り詰める
+    count = os.path.getsize(segments[-1]) // EVENT_DTYPE.itemsize
+    os.truncate(segments[-1], count * EVENT_DTYPE.itemsize)
+    return {
+        "directory": directory,
+        "snapshot": _sequence(snapshots[-1]) if snapshots else 0,
+        "segment": segments[-1],
+        "next_sequence": _sequence(segments[-1]) + count,
+        "file": open(segments[-1], "ab"),
+        "lock": threading.Lock(),
+        "compaction": threading.Lock()
+    }
+
+
+# イベントの追記（レコード配列をまとめて書き込み、通し番号の範囲を返す）
+def append_events(log, events):
+    events = np.ascontiguousarray(events, dtype=EVENT_DTYPE)
+    with log["lock"]:
+        log["file"].write(events.tobytes())
+        log["file"].flush()
+        start = log["next_sequence"]
+        log["next_sequence"] += len(events)
+    return start, log["next_sequence"]
+
+
+# イベントレコードの作成（party・prices は人数区分ごとの人数・1人あたり料金）
+def make_events(
+    kind, source, reservation_ids, farm_ids, customer_ids, dates, time_slots, party, prices, statuses, timestamps=None
+):
+    events = np.zeros(len(reservation_ids), dtype=EVENT_DTYPE)
+    events["timestamp"] = np.datetime64(datetime.now(), "s").astype(np.int64) if timestamps is None else timestamps
+    events["reservation_id"] = reservation_ids
+    events["farm_id"] = farm_ids
+    events["customer_id"] = customer_ids
+    events["date"] = np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+    events["kind"] = kind
+    events["status"] = statuses
+    events["time_slot"] = time_slots
+    for column in PARTY_COLUMNS:
+        events[column] = party[column]
+    for column in PRICE_COLUMNS:
+        events[column] = prices[column]
+    events["source"] = EVENT_SOURCES.index(source)
+    return events
+
+
+# 予約データ（コンパクトな型）を登録イベントと状態変更イベントに変換
+def events_from_reservations(reservations_df, source):
+    status_codes = reservations_df["status"].cat.codes.values
+    created_at = reservations_df["created_at"].values.astype("datetime64[s]").astype(np.int64)
+    columns = (
+        reservations_df["id"].values, reservations_df["farm_id"].values, reservations_df["customer_id"].values,
+        reservations_df["date"].values, reservations_df["time_slot"].values,
+        {column: reservations_df[column].values for column in PARTY_COLUMNS},
+        {column: reservations_df[column].values for column in PRICE_COLUMNS}
+    )
+    created = make_events(EVENT_CREATED, source, *columns, RESERVATION_STATUSES.index("確定"), created_at)
+
+    changed = status_codes != RESERVATION_STATUSES.index("確定")
+    updates = make_events(
+        EVENT_STATUS, source,
+        *(column[changed] for column in columns[:5]),
+        *({column: values[changed] for column, values in amounts.items()} for amounts in columns[5:]),
+        status_codes[changed],
+        reservations_df["date"].values.astype("datetime64[s]").astype(np.int64)[changed]
+    )
+    return np.concatenate([created, updates])
+
+
+# 通し番号 start 以降（end を指定した場合は end より前まで）のイベント（セグメントごとの memmap を連結せずに返す）
+def _read_segments(directory, start, end=None):
+    for path in sorted(glob.glob(os.path.join(directory, "events-*.log")), key=_sequence):
+        count = os.path.getsize(path) // EVENT_DTYPE.itemsize
+        base = _sequence(path)
+        if end is not None:
+            count = min(count, end - base)
+        if count <= 0 or base + count <= start:
+            continue
+        events = np.memmap(path, dtype=EVENT_DTYPE, mode="r", shape=(count,))
+        yield events[max(0, start - base):]
+
+
+# スナップショットとその通し番号（存在しない場合は空の状態）
+# コンパクションで古いスナップショットが削除される前に開くよう、ロックを取って memmap を開く
+def _read_snapshot(log):
+    with log["lock"]:
+        sequence = log["snapshot"]
+        if sequence == 0:
+            return np.zeros(0, dtype=STATE_DTYPE), sequence
+        return np.load(_snapshot_path(log["directory"], sequence), mmap_mode="r"), sequence
+
+
+# イベントを状態に反映（登録イベントは行を追加し、状態変更は予約ごとの最後の変更だけを反映）
+def replay(state, events):
+    created = events[events["kind"] == EVENT_CREATED]
+    rows = np.zeros(len(created), dtype=STATE_DTYPE)
+    for field in ["farm_id", "customer_id", "date", "time_slot", *PARTY_COLUMNS, *PRICE_COLUMNS, "status"]:
+        rows[field] = created[field]
+    rows["id"] = created["reservation_id"]
+    rows["created_at"] = created["timestamp"]
+    state = np.concatenate([state, rows])
+
+    updates = events[events["kind"] == EVENT_STATUS]
+    if len(updates) > 0 and len(state) > 0:
+        reservation_ids, last = np.unique(updates["reservation_id"][::-1], return_index=True)
+        order = np.argsort(state["id"], kind="stable")
+        position = np.minimum(np.searchsorted(state["id"], reservation_ids, sorter=order), len(state) - 1)
+        rows = order[position]
+        known = state["id"][rows] == reservation_ids
+        state["status"][rows[known]] = updates["status"][::-1][last][known]
+    return state
+
+
+# スナップショットとそれ以降のイベントを再生した現在の状態（farm_id を指定した場合はその農園のみ、
+# end を指定した場合は通し番号 end より前のイベントまで）
+# 農園を指定した場合はスナップショットの memmap から該当する行だけを読み込む
+def load_state(log, farm_id=None, end=None):
+    snapshot, start = _read_snapshot(log)
+    state = np.array(snapshot) if farm_id is None else snapshot[snapshot["farm_id"] == farm_id]
+    for events in _read_segments(log["directory"], start, end):
+        if farm_id is not None:
+            events = events[events["farm_id"] == farm_id]
+        state = replay(state, events)
+    return state
+
+
+# 状態をコンパクトな型の予約データに変換
+def state_to_frame(state):
+    return pd.DataFrame({
+        "id": state["id"],
+        "farm_id": state["farm_id"],
+        "customer_id": state["customer_id"],
+        "date": state["date"].astype("datetime64[D]").astype("datetime64[s]"),
+        "time_slot": state["time_slot"],
+        "adults": state["adults"],
+        "children": state["children"],
+        "seniors": state["seniors"],
+        "adult_price": state["adult_price"],
+        "child_price": state["child_price"],
+        "senior_price": state["senior_price"],
+        "status": pd.Categorical.from_codes(state["status"], categories=RESERVATION_STATUSES),
+        "created_at": state["created_at"].astype("datetime64[s]")
+    }).sort_values("id", ignore_index=True)
+
+
+# スナップショット以降のイベント数
+def events_since_snapshot(log):
+    return log["next_sequence"] - log["snapshot"]
+
+
+# 最大の予約ID（イベントがない場合は0）
+def max_reservation_id(log):
+    state, start = _read_snapshot(log)
+    candidates = [int(state["id"].max()) if len(state) > 0 else 0]
+    candidates += [int(events["reservation_id"].max()) for events in _read_segments(log["directory"], start)]
+    return max(candidates)
+
+
+# スナップショットの作成（コンパクション、前回のスナップショット以降にイベントがない場合は何もしない）
+# 追記を止めるのは通し番号を決めて新しいセグメントへ切り替える間だけで、
+# その番号より前のイベントの再生とスナップショットの書き込みは追記と並行に行う
+def compact_event_log(log):
+    with log["compaction"]:
+        with log["lock"]:
+            sequence = log["next_sequence"]
+            if sequence == log["snapshot"]:
+                return sequence
+            log["file"].close()
+            log["segment"] = _segment_path(log["directory"], sequence)
+            log["file"] = open(log["segment"], "ab")
+
+        state = load_state(log, end=sequence)
+        temporary = os.path.join(log["directory"], "snapshot.tmp.npy")
+        np.save(temporary, state)
+        os.replace(temporary, _snapshot_path(log["directory"], sequence))
+
+        with log["lock"]:
+            previous_snapshot, log["snapshot"] = log["snapshot"], sequence
+            if 0 < previous_snapshot != sequence:
+                os.remove(_snapshot_path(log["directory"], previous_snapshot))
+    return sequence
+
+
+# 操作履歴（新しい順、reservation_id を指定した場合はその予約のみ）
+# 新しいセグメントから順に memmap 上で絞り込み、limit 件に達するまでの該当レコードだけを読み込む
+def event_history(log, reservation_id=None, limit=50):
+    parts = []
+    remaining = limit
+    for segment in reversed(list(_read_segments(log["directory"], 0))):
+        if remaining <= 0:
+            break
+        if reservation_id is None:
+            rows = np.arange(max(0, len(segment) - remaining), len(segment))
+        else:
+            rows = np.flatnonzero(segment["reservation_id"] == reservation_id)[-remaining:]
+        parts.append(segment[rows[::-1]])
+        remaining -= len(rows)
+    events = np.concatenate(parts) if parts else np.zeros(0, dtype=EVENT_DTYPE)
+    return pd.DataFrame({
+        "timestamp": pd.to_datetime(events["timestamp"], unit="s"),
+        "source": np.array(EVENT_SOURCES)[events["source"]],
+        "kind": [EVENT_KINDS[kind] for kind in events["kind"]],
+        "reservation_id": events["reservation_id"],
+        "farm_id": events["farm_id"],
+        "customer_id": events["customer_id"],
+        "status": np.array(RESERVATION_STATUSES)[events["status"]]
+    })
@@ -0,0 +1,88 @@
+# 予約・顧客データのコンパクトな表現
+#
+# - 状態・年齢層・都道府県はカテゴリ型（整数コード）
+# - 日付は datetime64（pandas の最小単位である秒精度）
+# - 時間帯は開始時刻（時）、人数は uint8
+# - 料金は予約時に確定した人数区分ごとの1人あたり料金（円）で int32
+# - 顧客の好みの作物は CSR 形式（全顧客分を連結したコード配列と、顧客ごとの開始位置）
+import numpy as np
+import pandas as pd
+
+RESERVATION_STATUSES = ["確定", "キャンセル", "利用済み"]
+AGE_GROUPS = ["20代", "30代", "40代", "50代", "60代以上"]
+CROPS = ["いちご", "りんご", "ぶどう", "みかん", "さくらんぼ"]
+PARTY_COLUMNS = ["adults", "children", "seniors"]
+PRICE_COLUMNS = ["adult_price", "child_price", "senior_price"]
+
+
+# 時間帯の開始時刻（"9:00" 形式の文字列にも対応）
+def slot_hours(values):
+    values = pd.Series(values)
+    if values.dtype == object:
+        values = values.astype(str).str.split(":").str[0].astype(int)
+    return values.astype(np.uint8).values
+
+
+# 時間帯の表示用文字列
+def format_time_slot(hour):
+    return f"{int(hour)}:00"
+
+
+# 予約データをコンパクトな型に変換
+def compact_reservations(df):
+    return pd.DataFrame({
+        "id": df["id"].astype(np.int32).values,
+        "farm_id": df["farm_id"].astype(np.int16).values,
+        "customer_id": df["customer_id"].astype(np.int32).values,
+        "date": pd.to_datetime(df["date"]).astype("datetime64[s]").values,
+        "time_slot": slot_hours(df["time_slot"]),
+        "adults": df["adults"].astype(np.uint8).values,
+        "children": df["children"].astype(np.uint8).values,
+        "seniors": df["seniors"].astype(np.uint8).values,
+        "adult_price": df["adult_price"].astype(np.int32).values,
+        "child_price": df["child_price"].astype(np.int32).values,
+        "senior_price": df["senior_price"].astype(np.int32).values,
+        "status": pd.Categorical(df["status"], categories=RESERVATION_STATUSES),
+        "created_at": pd.to_datetime(df["created_at"]).astype("datetime64[s]").values
+    })
+
+
+# 好みの作物のリストを CSR 形式に変換
+def encode_preferences(preference_lists):
+    lengths = np.fromiter((len(prefs) for prefs in preference_lists), dtype=np.int64, count=len(preference_lists))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    crop_codes = {crop: code for code, crop in enumerate(CROPS)}
+    codes = np.fromiter(
+        (crop_codes[crop] for prefs in preference_lists for crop in prefs),
+        dtype=np.uint8,
+        count=int(offsets[-1])
+    )
+    return {"offsets": offsets, "codes": codes}
+
+
+# 指定した顧客（行番号）の好みの作物
+def decode_preferences(preferences, row):
+    start, end = preferences["offsets"][row], preferences["offsets"][row + 1]
+    return [CROPS[code] for code in preferences["codes"][start:end]]
+
+
+# 作物ごとの好む顧客数
+def preference_counts(preferences):
+    return pd.Series(np.bincount(preferences["codes"], minlength=len(CROPS)), index=CROPS)
+
+
+# 顧客データをコンパクトな型に変換（好みの作物は CSR 形式で別に返す）
+def compact_customers(df):
+    customers = pd.DataFrame({
+        "id": df["id"].astype(np.int32).values,
+        "name": df["name"].values,
+        "email": df["email"].values,
+        "phone": df["phone"].values,
+        "age_group": pd.Categorical(df["age_group"], categories=AGE_GROUPS),
+        "prefecture": df["prefecture"].astype("category").values,
+        "first_visit": pd.to_datetime(df["first_visit"]).astype("datetime64[s]").values,
+        "visit_count": df["visit_count"].astype(np.uint8).values
+    })
+    return customers, encode_preferences(list(df["preferences"]))
@@ -0,0 +1,61 @@
+# backend.py の予約処理のテスト（イベントログは一時ディレクトリに作成する）
+import pandas as pd
+import pytest
+
+import backend
+
+PARTY = {"adults": 1, "children": 0, "seniors": 0}
+
+
+# 一時ディレクトリのイベントログを使う新しい予約ストア（受付上限の索引もこのストアから作り直す）
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, "EVENT_LOG_DIR", str(tmp_path / "events"))
+    monkeypatch.setitem(backend._booking_registry, "store", None)
+    monkeypatch.setitem(backend._availability_registry, "index", None)
+    return backend._booking_store()
+
+
+# バックグラウンドの繰り上げ処理の完了を待つ（executor は1スレッドのため後から投入した処理で待てる）
+def _wait_for_promotion(store):
+    store["executor"].submit(lambda: None).result(timeout=30)
+
+
+def test_cancellation_promotes_waiting_party(store):
+    date = pd.Timestamp.now().normalize() + pd.Timedelta(days=5)
+    remaining = backend.remaining_capacity(1, date, 10)
+    assert remaining > 0
+
+    # 時間帯を満席にしてからキャンセル待ちに登録
+    filler = backend.create_reservation(1, 1, date, 10, {**PARTY, "adults": remaining})
+    assert filler is not None
+    assert backend.remaining_capacity(1, date, 10) == 0
+    assert backend.create_reservation(1, 2, date, 10, PARTY) is None
+    backend.add_to_waitlist(1, 2, date, 10, PARTY)
+    quoted = backend.quote_prices(1, date, 10)
+
+    assert backend.cancel_reservation(filler, farm_id=1)
+    _wait_for_promotion(store)
+
+    entry = backend.get_waitlist().iloc[0]
+    assert entry["status"] == "繰り上げ済み"
+    reservations = backend.get_shard(1)["reservations"]
+    promoted = reservations[reservations["id"] == entry["reservation_id"]].iloc[0]
+    assert promoted["customer_id"] == 2
+    assert promoted["status"] == "確定"
+    assert [promoted[column] for column in backend.PRICE_COLUMNS] == list(quoted)
+    assert backend.remaining_capacity(1, date, 10) == remaining - 1
+
+
+def test_waiting_party_larger_than_freed_seats_stays_waiting(store):
+    date = pd.Timestamp.now().normalize() + pd.Timedelta(days=6)
+    remaining = backend.remaining_capacity(2, date, 11)
+    assert remaining > 1
+
+    small = backend.create_reservation(2, 1, date, 11, PARTY)
+    backend.create_reservation(2, 3, date, 11, {**PARTY, "adults": remaining - 1})
+    backend.add_to_waitlist(2, 2, date, 11, {**PARTY, "adults": 2})
+
+    assert backend.cancel_reservation(small, farm_id=2)
+    _wait_for_promotion(store)
+    assert backend.get_waitlist().iloc[0]["status"] == "待機中"
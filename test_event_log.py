@@ -0,0 +1,129 @@
+# event_log.py のテスト（再生・農園での絞り込み・コンパクション）
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import event_log
+from event_log import (
+    EVENT_CREATED, EVENT_STATUS, append_events, compact_event_log, event_history, load_state, make_events,
+    max_reservation_id, open_event_log
+)
+from schema import PARTY_COLUMNS, PRICE_COLUMNS, RESERVATION_STATUSES
+
+CONFIRMED = RESERVATION_STATUSES.index("確定")
+CANCELLED = RESERVATION_STATUSES.index("キャンセル")
+USED = RESERVATION_STATUSES.index("利用済み")
+
+
+# 予約 reservation_ids の登録イベント（農園は farm_ids、人数は大人1人、料金は予約IDに応じて変える）
+def created(reservation_ids, farm_ids):
+    count = len(reservation_ids)
+    return make_events(
+        EVENT_CREATED, "画面", reservation_ids, farm_ids, np.full(count, 7), np.full(count, "2030-05-01"),
+        np.full(count, 10), {column: np.full(count, column == "adults") for column in PARTY_COLUMNS},
+        {column: np.asarray(reservation_ids) * 10 for column in PRICE_COLUMNS}, CONFIRMED
+    )
+
+
+# 予約 reservation_id の状態変更イベント
+def status_changed(reservation_id, farm_id, status):
+    return make_events(
+        EVENT_STATUS, "画面", [reservation_id], [farm_id], [7], ["2030-05-01"], [10],
+        {column: [0] for column in PARTY_COLUMNS}, {column: [0] for column in PRICE_COLUMNS}, status
+    )
+
+
+# 予約IDごとの状態
+def statuses(state):
+    return dict(zip(state["id"].tolist(), state["status"].tolist()))
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = open_event_log(str(tmp_path))
+    yield log
+    log["file"].close()
+
+
+def test_replay_applies_last_status_change(log):
+    append_events(log, created([1, 2, 3], [1, 2, 1]))
+    append_events(log, status_changed(1, 1, CANCELLED))
+    append_events(log, status_changed(1, 1, USED))
+    append_events(log, status_changed(3, 1, CANCELLED))
+    append_events(log, status_changed(99, 1, CANCELLED))
+
+    state = load_state(log)
+    assert statuses(state) == {1: USED, 2: CONFIRMED, 3: CANCELLED}
+    assert state["adult_price"].tolist() == [10, 20, 30]
+    assert state["adults"].tolist() == [1, 1, 1]
+    assert max_reservation_id(log) == 99
+
+
+def test_load_state_filters_by_farm_across_snapshot(log):
+    append_events(log, created([1, 2, 3, 4], [1, 2, 1, 2]))
+    append_events(log, status_changed(2, 2, CANCELLED))
+    compact_event_log(log)
+    append_events(log, created([5, 6], [1, 2]))
+    append_events(log, status_changed(3, 1, USED))
+
+    full = load_state(log)
+    for farm_id in [1, 2]:
+        farm_state = load_state(log, farm_id)
+        assert set(farm_state["farm_id"].tolist()) == {farm_id}
+        np.testing.assert_array_equal(
+            np.sort(farm_state, order="id"), np.sort(full[full["farm_id"] == farm_id], order="id")
+        )
+    assert statuses(load_state(log, 1)) == {1: CONFIRMED, 3: USED, 5: CONFIRMED}
+    assert statuses(load_state(log, 2)) == {2: CANCELLED, 4: CONFIRMED, 6: CONFIRMED}
+
+
+def test_repeated_compaction_keeps_snapshot(log, tmp_path):
+    append_events(log, created([1, 2], [1, 1]))
+    assert compact_event_log(log) == 2
+    assert compact_event_log(log) == 2
+    assert os.path.exists(tmp_path / f"snapshot-{2:012d}.npy")
+    assert statuses(load_state(log)) == {1: CONFIRMED, 2: CONFIRMED}
+
+    # 新しいイベントの後のコンパクションでは前回のスナップショットだけを削除する
+    append_events(log, status_changed(1, 1, CANCELLED))
+    assert compact_event_log(log) == 3
+    assert compact_event_log(log) == 3
+    assert sorted(os.listdir(tmp_path)) == [
+        f"events-{0:012d}.log", f"events-{2:012d}.log", f"events-{3:012d}.log", f"snapshot-{3:012d}.npy"
+    ]
+    assert statuses(load_state(log)) == {1: CANCELLED, 2: CONFIRMED}
+
+    # 開き直しても同じ状態・通し番号になり、操作履歴は古いセグメントも含む
+    reopened = open_event_log(str(tmp_path))
+    assert reopened["snapshot"] == 3 and reopened["next_sequence"] == 3
+    assert statuses(load_state(reopened)) == {1: CANCELLED, 2: CONFIRMED}
+    assert event_history(reopened)["reservation_id"].tolist() == [1, 2, 1]
+    reopened["file"].close()
+
+
+def test_compaction_does_not_block_appends(log, monkeypatch):
+    append_events(log, created([1, 2], [1, 2]))
+
+    # スナップショットの再生中に別スレッドから追記できること
+    replaying, appended = threading.Event(), threading.Event()
+    original = event_log.load_state
+
+    def slow_load_state(*args, **kwargs):
+        replaying.set()
+        assert appended.wait(timeout=10)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(event_log, "load_state", slow_load_state)
+    compaction = threading.Thread(target=compact_event_log, args=(log,))
+    compaction.start()
+    assert replaying.wait(timeout=10)
+    append_events(log, created([3], [1]))
+    appended.set()
+    compaction.join(timeout=10)
+
+    monkeypatch.setattr(event_log, "load_state", original)
+    assert log["snapshot"] == 2
+    assert statuses(load_state(log)) == {1: CONFIRMED, 2: CONFIRMED, 3: CONFIRMED}
+    assert len(np.load(os.path.join(log["directory"], f"snapshot-{2:012d}.npy"))) == 2